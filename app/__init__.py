@@ -1,7 +1,30 @@
+import os
+
 from flask import Flask
 from flask_bootstrap import Bootstrap
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1000 * 1000  # Max file size is 2MB
+app.config['OCR_CACHE_DIR'] = "cache/ocr"
+app.config['OCR_CACHE_MAX_SIZE'] = 200 * 1000 * 1000  # Max cache size is 200MB
+app.config['OCR_CACHE_MAX_AGE'] = 30 * 24 * 60 * 60  # Keep OCR results for 30 days
+app.config['OCR_JOBS_DB'] = "cache/jobs.sqlite"
+app.config['UPLOAD_DIR'] = "cache/uploads"  # Uploaded pdfs wait here for their OCR job
+app.config['OCR_WORKERS'] = 1  # OCR threads per uWSGI process
+app.config['OCR_QUEUE_DEPTH'] = 20  # Max queued and running OCR jobs, uploads are refused when the queue is full
+app.config['OCR_JOB_TIMEOUT'] = 30  # Max seconds a single OCR job may take
+app.config['OCR_JOB_MAX_AGE'] = 60 * 60  # Keep finished jobs for an hour
+app.config['API_MAX_WAIT'] = 5  # Max seconds an API request waits for its OCR jobs, well below harakiri in bon_splitser.ini
+app.config['OCR_JOBS_PER_CLIENT'] = 5  # Max queued and running OCR jobs of a single ip address
+app.config['ADMISSION_DB'] = "cache/admission.sqlite"
+app.config['UPLOADS_PER_MINUTE'] = 6  # Uploads a single ip address can do per minute after the burst is used
+app.config['UPLOAD_BURST'] = 5  # Uploads a single ip address can do at once
+app.config['OCR_STRIPS'] = 1  # Split tall receipts into this many strips that are OCRed in parallel, 1 to not split
+app.config['OCR_WARMUP'] = os.environ.get("OCR_WARMUP") == "1"  # Load the OCR libraries and engines in wsgi.py before forking
+app.config['RECEIPT_DB'] = "cache/receipts.sqlite"
+app.config['RECEIPT_TTL'] = 24 * 60 * 60  # Keep parsed receipts for a day after they were last used
+app.config['PRODUCT_DB'] = "cache/products.sqlite"
+app.config['PRODUCT_MAX'] = 50 * 1000  # Max product names to remember, the least recently seen are removed
+app.config['METRICS_ENABLED'] = False  # Record processing times, served on /metrics for local requests
 Bootstrap(app)
-from app import routes
+from app import routes, api
@@ -0,0 +1,36 @@
+import math
+import time
+
+from app.db import SQLiteStore
+
+
+class RateLimiter(SQLiteStore):
+    """Token bucket per client backed by SQLite, the buckets are shared by all worker processes.
+
+    Every client can do burst requests at once, after that the bucket is refilled with rate tokens per second.
+    """
+    def __init__(self, db_path, rate, burst):
+        super().__init__(db_path)
+        self.rate = rate  # Tokens added per second
+        self.burst = burst  # Max tokens in a bucket
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS buckets (client TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def take(self, client, tokens=1):
+        """Take tokens from the bucket of a client. Returns 0 if they were taken, otherwise the seconds to wait.
+        Raises ValueError for more tokens than fit in a bucket, they could never be taken."""
+        if tokens > self.burst:
+            raise ValueError(f"Can't take {tokens} tokens, the burst is {self.burst}")
+        now = time.time()
+        with self.transaction() as db:
+            # Buckets that are full again are the same as no bucket
+            db.execute("DELETE FROM buckets WHERE updated < ?", (now - self.burst / self.rate,))
+            row = db.execute("SELECT tokens, updated FROM buckets WHERE client = ?", (client,)).fetchone()
+            available = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+            if available < tokens:
+                wait = (tokens - available) / self.rate
+            else:
+                wait = 0
+                db.execute("INSERT OR REPLACE INTO buckets (client, tokens, updated) VALUES (?, ?, ?)",
+                           (client, available - tokens, now))
+        return math.ceil(wait)
@@ -1,6 +1,12 @@
+import concurrent.futures
+import contextlib
+import csv
 import decimal
+import functools
 import io
+import itertools
 import re
+import threading
 
 import cv2
 import fitz
@@ -9,75 +15,239 @@ import pandas as pd
 import PIL.Image as Image
 import pytesseract
 
-
-class Receipt:
-    def __init__(self, supermarket, participants):
-        self.supermarket = supermarket
-        self.participants = participants
-        self.subtotal = 0
-        self.subtotal_conf = None
-        self.bonus = 0
-        self.bonus_conf = None
-        self.total = 0
-        self.total_conf = None
-        self.items = []
-        self.bonus_items = []
-        self.verify = {}
-
-    def add_item(self, price, price_conf, bonus, item_text):
-        """Add item to receipt."""
-        self.items.append(pd.DataFrame([{"price": price, "price_conf": price_conf, "bonus": bonus, "item_text": item_text}]))
-
-    def add_bonus_item(self, bonus_price, price_conf, bonus_text):
-        """Add bonus item to receipt."""
-        self.bonus_items.append(pd.DataFrame([{"price": bonus_price, "price_conf": price_conf, "bonus_text": bonus_text}]))
-
-    def merge_items(self):
-        """Concat dfs of parsed items."""
-        self.items = pd.concat(self.items)
-        self.items.reset_index(drop=True, inplace=True)
-        if self.bonus_items:
-            self.bonus_items = pd.concat(self.bonus_items)
-            self.bonus_items.reset_index(drop=True, inplace=True)
-
-    def verify_prices(self):
-        """Check if all the totals match."""
-        subtotal = self.items["price"].sum() == self.subtotal
-        if len(self.bonus_items) > 0:
-            bonus = self.bonus_items["price"].sum() == self.bonus
-        else:  # No bonus items, always correct
-            bonus = True
-        total = (self.subtotal - self.bonus) == self.total
-        totals = {"subtotal": subtotal, "bonus": bonus, "total": total}
-        self.verify = totals
-        if sum(totals.values()) == len(totals):
-            print("All items and totals add up.")
-        else:
-            print(f"Totals do not add up: {totals}")  # TODO log this
-            for key, correct in totals.items():
-                if not correct:
-                    print(f"{key} does not add up!")
-
-
-def img_from_pdf(pdf):
-    """Extract image from the pdf."""
-    if type(pdf) is bytes:  # When receiving pdf as bytes from web app
-        doc = fitz.open("input_pdf", pdf)
-    else:  # Receive filepath of pdf
-        doc = fitz.open(pdf)
-
-    xref = doc.getPageImageList(0)[0][0]  # Locate xref of first image in first page
-    img_data = doc.extract_image(xref)
-    image = Image.open(io.BytesIO(img_data["image"]))
-    image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)  # Convert from PIL image to cv2 image
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+from app import metrics
+from app.layouts import LAYOUTS
+from app.products import link_bonus_items
+from app.receipt import Receipt  # Receipt used to be defined here, still importable from this module
+from app.splitter import from_cents, to_cents
+
+try:  # Optional, keeps Tesseract loaded in memory. Falls back to pytesseract when not installed
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+OCR_LANG = "nld"
+OCR_PSM = 6
+OCR_CONFIG = f"--psm {OCR_PSM}"
+OCR_ENGINE = "tesserocr" if tesserocr is not None else "pytesseract"
+OCR_MODES = {  # Engine settings per kind of OCR: whole receipt page or a single price
+    "page": {"psm": OCR_PSM},
+    "price": {"psm": 7, "whitelist": "0123456789,-"},  # Single line with only price characters
+}
+REOCR_CONF = 90  # Prices with a lower confidence are read again when the totals don't add up
+REOCR_MAX_PRICES = 8  # Max prices that are read again, all combinations of old and new prices are tried
+REOCR_PADDING = 4  # Pixels around the price that are included in the crop
+PRICE_RE = re.compile(r"\d{1,2},\d{2}")  # Words that start like a price, also the price of a single item
+CENTS_RE = re.compile(r"(\d*)[.,](\d{2})|(\d{2,})")  # Common price formats that are converted to cents without Decimal
+TOKEN_KINDS = ["text", "price", "bonus_id", "start", "bonuskaart", "subtotal", "bonus_total", "total"]
+KIND = {kind: code for code, kind in enumerate(TOKEN_KINDS)}
+REOCR_PRICE_RE = re.compile(r"\d+,?\d{2}")  # A price read again on its own, the decimal comma is sometimes missed
+MAX_PAGES = 1  # Receipts from the AH app are a single page
+MAX_IMAGE_PIXELS = 20 * 1000 * 1000  # Larger images are refused before they are decoded
+MIN_TEXT_WORDS = 10  # Pages with a smaller text layer are treated as image only and are read with OCR
+PREPROCESS = {  # Image preprocessing before OCR, see preprocess_image
+    "crop": True,  # Cut off the white margins around the text
+    "crop_threshold": 200,  # Pixels darker than this are text
+    "crop_padding": 10,  # Pixels of margin to keep around the text
+    "max_dpi": 300,  # Downsample images with a higher resolution, None to keep the resolution
+    "binarize": False,  # Convert to black and white with Otsu's threshold
+}
+STRIP_MIN_HEIGHT = 400  # Min pixel height of a strip when a receipt is split for parallel OCR
+STRIP_BLANK_THRESHOLD = 200  # Rows without pixels darker than this are blank, strips are only cut at blank rows
+TSV_COLUMNS = ["level", "page_num", "block_num", "par_num", "line_num", "word_num", "left", "top", "width", "height",
+               "conf", "text"]
+TSV_DTYPES = {"text": str}  # Words that are all digits would otherwise make the text column numeric, "199" becomes "199.0"
+
+
+class ReceiptError(ValueError):
+    """Raised when a pdf is refused before it is read."""
+
+
+class TooManyPages(ReceiptError):
+    """Raised when the pdf has more pages than a receipt."""
+
+
+class ImageTooLarge(ReceiptError):
+    """Raised when the image in the pdf has too many pixels to be decoded."""
+
+
+def open_pdf(pdf):
+    """Open the pdf from bytes or a filepath. Files are read by MuPDF itself, without a copy in Python."""
+    try:
+        if isinstance(pdf, (bytes, bytearray, memoryview)):  # When receiving pdf as bytes from web app
+            return fitz.open(stream=pdf, filetype="pdf")
+        return fitz.open(pdf)  # Receive filepath of pdf
+    except RuntimeError as e:  # MuPDF raises RuntimeError for files it can't read
+        raise ReceiptError("Not a readable pdf") from e
+
+
+def check_pdf(doc):
+    """Refuse pdfs that can't be a receipt, using only the pdf structure and image headers. Raises ReceiptError."""
+    if doc.page_count == 0:
+        raise ReceiptError("The pdf has no pages")
+    if doc.page_count > MAX_PAGES:
+        raise TooManyPages(f"The pdf has {doc.page_count} pages, at most {MAX_PAGES} allowed")
+    for image in doc.get_page_images(0):
+        width, height = image[2], image[3]
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ImageTooLarge(f"Image of {width}x{height} pixels is larger than {MAX_IMAGE_PIXELS} pixels")
+
+
+def text_from_pdf(doc):
+    """Read the words from the text layer of the pdf. Returns the same dataframe as receipt_ocr, None if there is no usable text layer."""
+    words = [word for word in doc[0].get_text("words") if word[4].strip()]
+    if len(words) < MIN_TEXT_WORDS:
+        return None
+    df = pd.DataFrame(words, columns=["x0", "y0", "x1", "y1", "text", "block_no", "line_no", "word_no"])
+    # Group words into lines by vertical position, prices can be in a different text block than the item text
+    df["mid"] = (df["y0"] + df["y1"]) / 2
+    df = df.sort_values(["mid", "x0"], kind="stable").reset_index(drop=True)
+    global_line = np.empty(len(df), dtype=int)
+    line_nr = 0
+    line_mid = df.at[0, "mid"]
+    for i, (mid, y0, y1) in enumerate(zip(df["mid"], df["y0"], df["y1"])):
+        if abs(mid - line_mid) > (y1 - y0) / 2:  # Word is not on the current line
+            line_nr += 1
+            line_mid = mid
+        global_line[i] = line_nr
+    df["global_line"] = global_line
+    df = df.sort_values(["global_line", "x0"], kind="stable").reset_index(drop=True)
+    df["word_num"] = df.groupby("global_line").cumcount() + 1
+    df["conf"] = 100.0  # Text layer is exact
+    df["left"] = df["x0"].round().astype(int)
+    df["top"] = df["y0"].round().astype(int)
+    df["width"] = (df["x1"] - df["x0"]).round().astype(int)
+    df["height"] = (df["y1"] - df["y0"]).round().astype(int)
+    return df[["word_num", "conf", "text", "left", "width", "top", "height", "global_line"]]
+
+
+def img_from_pdf(pdf, preprocess=None):
+    """Extract image from the pdf as grayscale, preprocessed with the preprocess settings if given."""
+    if isinstance(pdf, fitz.Document):
+        doc = pdf
+    else:
+        doc = open_pdf(pdf)
+
+    with metrics.stage("image_extraction"):
+        xref = doc.get_page_images(0)[0][0]  # Locate xref of first image in first page
+        img_data = doc.extract_image(xref)
+        image = cv2.imdecode(np.frombuffer(img_data["image"], np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:  # Format that OpenCV can't decode, PIL supports more
+            image = np.array(Image.open(io.BytesIO(img_data["image"])).convert("L"))
+    if preprocess is not None:
+        dpi = image.shape[1] / (doc[0].rect.width / 72)  # Image covers the width of the page, which is in points
+        image = preprocess_image(image, dpi, preprocess)
     #cv2.imwrite('tmp_data/OCR.png', image)
+    metrics.observe("image_width_pixels", image.shape[1])
+    metrics.observe("image_height_pixels", image.shape[0])
     return image
 
 
-def receipt_ocr(image):
-    """Perform OCR on the receipt image, return dataframe."""
-    ocr_out = pytesseract.image_to_data(image, config="--psm 6", lang="nld", output_type=pytesseract.Output.DATAFRAME)
+def preprocess_image(image, dpi, settings):
+    """Crop, rescale and binarize a grayscale receipt image to make OCR faster."""
+    if settings.get("crop"):
+        with metrics.stage("preprocess_crop"):
+            threshold = settings["crop_threshold"]
+            rows = np.flatnonzero(image.min(axis=1) < threshold)  # Darkest pixel per row, avoids a full size mask
+            cols = np.flatnonzero(image.min(axis=0) < threshold)
+            if len(rows):  # Don't crop empty images
+                padding = settings["crop_padding"]
+                image = image[max(rows[0] - padding, 0):rows[-1] + padding + 1,
+                              max(cols[0] - padding, 0):cols[-1] + padding + 1]
+    max_dpi = settings.get("max_dpi")
+    if max_dpi and dpi > max_dpi:
+        with metrics.stage("preprocess_rescale"):
+            scale = max_dpi / dpi
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    if settings.get("binarize"):
+        with metrics.stage("preprocess_binarize"):
+            _, image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return np.ascontiguousarray(image)
+
+
+class PytesseractEngine:
+    """OCR engine that runs the tesseract binary for every image."""
+    name = "pytesseract"
+
+    def __init__(self, lang=OCR_LANG, psm=OCR_PSM, whitelist=None):
+        self.lang = lang
+        self.config = f"--psm {psm}"
+        if whitelist:
+            self.config += f" -c tessedit_char_whitelist={whitelist}"
+
+    @property
+    def version(self):
+        return str(pytesseract.get_tesseract_version())
+
+    def image_to_data(self, image, timeout=0):
+        """Return Tesseract TSV output as dataframe."""
+        return pytesseract.image_to_data(image, config=self.config, lang=self.lang,
+                                         output_type=pytesseract.Output.DATAFRAME, timeout=timeout,
+                                         pandas_config={"dtype": TSV_DTYPES})
+
+
+class TesserocrEngine:
+    """OCR engine that keeps an initialized Tesseract API in memory, the model is only loaded once."""
+    name = "tesserocr"
+
+    def __init__(self, lang=OCR_LANG, psm=OCR_PSM, whitelist=None):
+        self.api = tesserocr.PyTessBaseAPI(lang=lang, psm=psm)
+        if whitelist:
+            self.api.SetVariable("tessedit_char_whitelist", whitelist)
+
+    @property
+    def version(self):
+        return tesserocr.tesseract_version().split()[1]  # First line is "tesseract <version>"
+
+    def image_to_data(self, image, timeout=0):
+        """Return Tesseract TSV output as dataframe. The image is passed in memory. Raises RuntimeError when recognition
+        takes longer than timeout seconds, like pytesseract."""
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+        self.api.SetImageBytes(image.tobytes(), width, height, bytes_per_pixel, bytes_per_pixel * width)
+        if not self.api.Recognize(int(timeout * 1000)):  # 0 is no timeout, recognition is stopped when it runs out
+            self.api.Clear()
+            raise RuntimeError("Tesseract process timeout")
+        tsv = self.api.GetTSVText(0)
+        return pd.read_csv(io.StringIO(tsv), sep="\t", names=TSV_COLUMNS, quoting=csv.QUOTE_NONE, dtype=TSV_DTYPES)
+
+
+OCR_ENGINES = {"pytesseract": PytesseractEngine, "tesserocr": TesserocrEngine}
+_engine_pools = {mode: [] for mode in OCR_MODES}  # Idle engines of this process per OCR mode, reused between receipts
+_engine_lock = threading.Lock()
+
+
+def new_engine(mode="page"):
+    """Initialize a new OCR engine, fall back to pytesseract when the selected engine can't be loaded."""
+    global OCR_ENGINE
+    try:
+        return OCR_ENGINES[OCR_ENGINE](**OCR_MODES[mode])
+    except RuntimeError as e:  # tesserocr raises RuntimeError when Tesseract can't be initialized
+        print(f"Could not load OCR engine {OCR_ENGINE}, falling back to pytesseract: {e}")  # TODO log this
+        OCR_ENGINE = "pytesseract"
+        return PytesseractEngine(**OCR_MODES[mode])
+
+
+@contextlib.contextmanager
+def ocr_engine(mode="page"):
+    """Lend an OCR engine from the pool. An engine is only used by one thread at a time."""
+    engine_pool = _engine_pools[mode]
+    with _engine_lock:
+        engine = engine_pool.pop() if engine_pool else None
+    if engine is None:
+        engine = new_engine(mode)
+    try:
+        yield engine
+    finally:
+        with _engine_lock:
+            engine_pool.append(engine)
+
+
+def ocr_words(image, timeout=0):
+    """Perform OCR on an image, return dataframe of the words with their line number."""
+    with ocr_engine() as engine, metrics.stage("tesseract"):
+        ocr_out = engine.image_to_data(image, timeout=timeout)
     df = ocr_out[["page_num", "block_num", "par_num", "line_num", "word_num", "conf", "text", "left", "width", "top", "height"]]
     df = df[df["conf"] > 0]
     # Create global line numbering
@@ -89,6 +259,62 @@ def receipt_ocr(image):
     return df
 
 
+def strip_cuts(image, strips):
+    """Return rows to cut the image at to get at most strips horizontal strips. Cuts are in the middle of blank gaps."""
+    strips = min(strips, image.shape[0] // STRIP_MIN_HEIGHT)
+    if strips < 2:
+        return []
+    blank = np.r_[False, image.min(axis=1) >= STRIP_BLANK_THRESHOLD, False]  # Row projection profile
+    edges = np.flatnonzero(blank[1:] != blank[:-1])  # Start and end of every blank gap
+    gaps = (edges[0::2] + edges[1::2]) // 2  # Middle row of every gap
+    gaps = gaps[(gaps > 0) & (gaps < image.shape[0] - 1)]
+    cuts = []
+    for i in range(1, strips):  # Take the gap closest to an even split, strips have to be at least the min height
+        target = i * image.shape[0] // strips
+        prev_cut = cuts[-1] if cuts else 0
+        options = gaps[(gaps >= prev_cut + STRIP_MIN_HEIGHT) & (gaps <= image.shape[0] - STRIP_MIN_HEIGHT)]
+        if len(options) == 0:
+            break
+        cuts.append(int(options[np.abs(options - target).argmin()]))
+    return cuts
+
+
+def receipt_ocr(image, timeout=0, strips=1):
+    """Perform OCR on the receipt image, return dataframe. Tesseract is killed after timeout seconds (0 is no limit).
+
+    Tall receipts can be split into strips that are read in parallel, the words are merged into one dataframe.
+    """
+    cuts = strip_cuts(image, strips)
+    if len(cuts) == 0:
+        return ocr_words(image, timeout=timeout)
+    offsets = [0] + cuts
+    parts = [image[start:end] for start, end in zip(offsets, cuts + [image.shape[0]])]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(parts)) as executor:  # Tesseract doesn't hold the GIL
+        dfs = list(executor.map(functools.partial(ocr_words, timeout=timeout), parts))
+    line_offset = 0
+    for df, offset in zip(dfs, offsets):
+        nr_lines = df["global_line"].max() + 1 if len(df) else 0
+        df["top"] += offset
+        df["global_line"] += line_offset
+        line_offset += nr_lines
+    return pd.concat(dfs, ignore_index=True)
+
+
+@functools.lru_cache(maxsize=None)
+def ocr_version():
+    """Return name and version of the OCR engine."""
+    with ocr_engine() as engine:
+        return f"{engine.name} {engine.version}"
+
+
+def warm_up():
+    """Load the OCR engines and cache the engine version, so the first receipt doesn't have to."""
+    for mode in OCR_MODES:
+        with ocr_engine(mode):
+            pass
+    ocr_version()
+
+
 def ah_price(price):
     """Format prices from AH supermarket."""
     price = price.replace(",", ".")
@@ -99,109 +325,249 @@ def ah_price(price):
     return price.quantize(cents, decimal.ROUND_HALF_UP)
 
 
-def parse_start(line, df_line):
-    """Check if the line of the receipt is the start of the item table. Returns what to do with the next line."""
-    for index, row in df_line.iterrows():  # Loop over words
-        if row["text"].upper() == "AANTAL" or row["text"].upper() == "OMSCHRIJVING" or row["text"].upper() == "PRIJS" or row["text"].upper() == "BEDRAG":
-            return "parse_items"
-    return "start"
-
-
-def parse_items(bonuskaart_skip, line, df_line, receipt):
-    """Parse shopping items from the receipt."""
-    # Check for bonuskaart line
-    if bonuskaart_skip == False:
-        for index, row in df_line.iterrows():  # Loop over words
-            if row["text"].upper() == "BONUSKAART":
-                return True, "parse_items", receipt  # Skip bonuskaart check from now on
-    # Check for subtotal line
-    for index, row in df_line.iterrows():  # Loop over words
-        if row["text"].upper() == "SUBTOTAAL":
-            receipt.subtotal = ah_price(df_line.iloc[-1]["text"])
-            receipt.subtotal_conf = df_line.iloc[-1]["conf"]
-            return bonuskaart_skip, "parse_bonus", receipt
-
-    # Get price and bonus info
-    bonus = None
-    price_loc = -1
-    last_row = df_line.iloc[price_loc]
-    for bonus_id in ["B", "35%"]: # Check for bonus and 35% discount
-        if bonus_id in last_row["text"].upper():  # Check if bonus present
-            bonus = bonus_id
-            if bonus_id == last_row["text"].upper():  # If word only contains the bonus_id and not the price
-                price_loc = -2
-                price_row = df_line.iloc[price_loc]  # Price row is the word before bonus_id
-            else:  # Price and bonus_id are in the same word. Need to extract price
-                last_row["text"] = last_row["text"].replace(bonus_id, "").replace(" ", "")  # Remove bonus_id and spaces
-                price_row = last_row
-            break
-    else:
-        price_row = last_row
-    price = ah_price(price_row["text"])
-    price_conf = price_row["conf"]
-
-    # Get item text
-    price_re = "\d{1,2},\d{2}"
-    item_text = ""
-    for index, row in df_line.iloc[0:price_loc].iterrows():  # Loop over words before price
-        if re.match(price_re, row["text"]):  # Skip price of single item
-            continue
+def ah_cents(prices):
+    """Convert price words from AH supermarket to integer cents, gives the same amounts as ah_price."""
+    cents = []
+    for price in prices:
+        match = CENTS_RE.fullmatch(price)
+        if match is None:  # Uncommon format, raises like ah_price if it isn't a price at all
+            cents.append(to_cents(ah_price(price)))
+        elif match[3] is not None:  # No decimal comma, the last 2 digits are the cents
+            cents.append(int(match[3]))
         else:
-            item_text = f"{item_text} {row['text']}"
-    receipt.add_item(price, price_conf, bonus, item_text)
-    return bonuskaart_skip, "parse_items", receipt
-
-
-def parse_bonus(line, df_line, receipt):
-    """Parse bonus items from the receipt."""
-    # Check for bonus total
-    for index, row in df_line.iterrows():  # Loop over words
-        if row["text"].upper() == "VOORDEEL":
-            receipt.bonus = ah_price(df_line.iloc[-1]["text"])
-            receipt.bonus_conf = df_line.iloc[-1]["conf"]
-            return "parse_total", receipt
-    # Parse bonus items
-    bonus_price = ah_price(df_line.iloc[-1]["text"].replace("-", ""))
-    price_conf = df_line.iloc[-1]["conf"]
-    bonus_text = df_line.iloc[0:-1]["text"].str.cat(sep=" ").upper()  # Merge bonus text
-    bonus_text = bonus_text.replace("BONUS", "").replace("35% K", "")
-    receipt.add_bonus_item(bonus_price, price_conf, bonus_text)
-    return "parse_bonus", receipt
-
-
-def parse_total(line, df_line, receipt):
-    """Parse total from receipt."""
-    for index, row in df_line.iterrows():  # Loop over words
-        if row["text"].upper() == "TOTAAL":
-            receipt.total = ah_price(df_line.iloc[-1]["text"])
-            receipt.total_conf = df_line.iloc[-1]["conf"]
-            return "end", receipt
-    return "parse_total", receipt
-
-
-def process_receipt(pdf, supermarket, participants):
-    """Parse a receipt pdf and return a Receipt object with all information."""
+            cents.append(int(match[1] or 0) * 100 + int(match[2]))
+    return cents
+
+
+class Tokenizer:
+    """Classifies every OCR word once into a token kind, with the precompiled tables of a supermarket layout.
+
+    Kinds are the small integer codes of TOKEN_KINDS: the keywords of the layout, bonus ids, words that look like a price
+    and all other text. The parse stages only compare kinds instead of matching every word again.
+    """
+    def __init__(self, layout):
+        self.layout = layout
+        self.keyword_kinds = {word: KIND[kind] for word, kind in layout["keywords"].items()}
+        for bonus_id in layout["bonus_ids"]:
+            self.keyword_kinds.setdefault(bonus_id, KIND["bonus_id"])
+
+    def tokenize(self, text):
+        """Return uppercase words and the token kind of every word of a series of OCR words."""
+        upper = text.str.upper()
+        kinds = upper.map(self.keyword_kinds)
+        is_price = text.str.match(PRICE_RE).fillna(False).to_numpy(dtype=bool)
+        kinds = np.where(kinds.isna(), np.where(is_price, KIND["price"], KIND["text"]), kinds.fillna(0)).astype(np.int8)
+        return upper, kinds
+
+
+TOKENIZERS = {supermarket: Tokenizer(layout) for supermarket, layout in LAYOUTS.items()}
+
+
+def first_line(line_mask, start):
+    """Return index of the first line from start that matches the mask, number of lines if there is none."""
+    hits = np.flatnonzero(line_mask[start:])
+    return start + hits[0] if len(hits) else len(line_mask)
+
+
+def join_lines(words, word_lines, lines, sep):
+    """Join the words of every line in lines with sep, in word order. Lines without words are empty strings."""
+    texts = dict.fromkeys(lines.tolist())
+    for line, word in zip(word_lines.tolist(), words.tolist()):
+        texts[line] = word if texts[line] is None else texts[line] + sep + word
+    return ["" if line_text is None else line_text for line_text in texts.values()]
+
+
+def parse_lines(df, receipt):
+    """Parse OCR words into the receipt. Classifies all words and lines at once with the tokenizer of the supermarket,
+    gives the same result as the old row by row parser in tests/legacy_parser.py."""
+    if len(df) == 0:
+        return receipt
+    tokenizer = TOKENIZERS[receipt.supermarket]
+    layout = tokenizer.layout
+    df = df.sort_values("global_line", kind="stable").reset_index(drop=True)
+    # Word positions within their line
+    line_ids = df["global_line"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, line_ids[1:] != line_ids[:-1]])  # First word of every line
+    ends = np.r_[starts[1:], len(df)] - 1  # Last word of every line
+    sizes = ends - starts + 1
+    word_line = np.repeat(np.arange(len(starts)), sizes)  # Line index of every word
+    word_pos = np.arange(len(df)) - np.repeat(starts, sizes)  # Position of every word in its line
+    text = df["text"]
+    text_arr = text.to_numpy(dtype=object)
+    conf_arr = df["conf"].to_numpy(dtype=float)  # Stored in the receipt as Python floats, unpickling it must not need numpy
+    box_arr = df[["left", "top", "width", "height"]].to_numpy()
+    upper, kinds = tokenizer.tokenize(text)
+
+    def line_has(kind):
+        return np.logical_or.reduceat(kinds == KIND[kind], starts)
+
+    def price_boxes(positions):
+        return [tuple(box) for box in box_arr[positions].tolist()]
+
+    def line_price(line):
+        return from_cents(ah_cents([text_arr[ends[line]]])[0])
+
+    # Find the line of every section of the receipt, see the parse stage functions for the rules
+    start_line = first_line(line_has("start"), 0)
+    bonuskaart_line = first_line(line_has("bonuskaart"), start_line + 1)
+    subtotal_mask = line_has("subtotal")
+    if bonuskaart_line < len(starts):
+        subtotal_mask[bonuskaart_line] = False  # The first bonuskaart line is skipped
+    subtotal_line = first_line(subtotal_mask, start_line + 1)
+    bonus_total_line = first_line(line_has("bonus_total"), subtotal_line + 1)
+    total_line = first_line(line_has("total"), bonus_total_line + 1)
+
+    # Shopping items
+    item_lines = np.arange(min(start_line + 1, len(starts)), subtotal_line)
+    item_lines = item_lines[item_lines != bonuskaart_line]
+    marker_only = (sizes[item_lines] == 1) & (kinds[ends[item_lines]] == KIND["bonus_id"])
+    if marker_only.any():  # Line without a price, bonus_only below would take the price of the line before
+        print(f"Skipped {marker_only.sum()} item lines with only a bonus id")  # TODO log this
+        item_lines = item_lines[~marker_only]
+    if len(item_lines):
+        last_pos = ends[item_lines]
+        last_upper = upper.iloc[last_pos].reset_index(drop=True)
+        bonus = np.full(len(item_lines), None, dtype=object)
+        for bonus_id in reversed(layout["bonus_ids"]):  # First matching bonus_id wins
+            bonus[last_upper.str.contains(bonus_id, regex=False).to_numpy(dtype=bool)] = bonus_id
+        bonus_only = kinds[last_pos] == KIND["bonus_id"]  # Word only contains the bonus_id, price is the word before
+        price_pos = np.where(bonus_only, last_pos - 1, last_pos)
+        price_text = text.iloc[price_pos].reset_index(drop=True)
+        for bonus_id in layout["bonus_ids"]:  # Price and bonus_id are in the same word, remove bonus_id and spaces
+            in_word = (bonus == bonus_id) & ~bonus_only
+            price_text[in_word] = price_text[in_word].str.replace(bonus_id, "", regex=False).str.replace(" ", "", regex=False)
+        prices = [from_cents(cents) for cents in ah_cents(price_text)]
+        # Item text is made of the words before the price, skipping the price of a single item
+        text_end = np.full(len(starts), -1)
+        text_end[item_lines] = sizes[item_lines] - np.where(bonus_only, 2, 1)
+        in_text = (word_pos < text_end[word_line]) & (kinds != KIND["price"])
+        item_texts = [f" {item_text}" if item_text else "" for item_text in
+                      join_lines(text_arr[in_text], word_line[in_text], item_lines, " ")]
+        receipt.add_items(prices, conf_arr[price_pos].tolist(), bonus.tolist(), item_texts, price_boxes(price_pos))
+
+    # Subtotal, bonus items and totals
+    if subtotal_line < len(starts):
+        receipt.subtotal = line_price(subtotal_line)
+        receipt.subtotal_conf = float(conf_arr[ends[subtotal_line]])
+        receipt.price_boxes["subtotal"] = price_boxes([ends[subtotal_line]])[0]
+        bonus_lines = np.arange(subtotal_line + 1, bonus_total_line)
+        if len(bonus_lines):
+            last_pos = ends[bonus_lines]
+            prices = [from_cents(cents) for cents in ah_cents(text.iloc[last_pos].str.replace("-", "", regex=False))]
+            in_text = np.zeros(len(starts), dtype=bool)
+            in_text[bonus_lines] = True
+            in_text = in_text[word_line] & (word_pos < sizes[word_line] - 1)
+            bonus_texts = join_lines(upper.to_numpy(dtype=object)[in_text], word_line[in_text], bonus_lines, " ")
+            for remove_text in layout["bonus_text_remove"]:
+                bonus_texts = [bonus_text.replace(remove_text, "") for bonus_text in bonus_texts]
+            receipt.add_bonus_items(prices, conf_arr[last_pos].tolist(), bonus_texts, price_boxes(last_pos))
+    if bonus_total_line < len(starts):
+        receipt.bonus = line_price(bonus_total_line)
+        receipt.bonus_conf = float(conf_arr[ends[bonus_total_line]])
+        receipt.price_boxes["bonus"] = price_boxes([ends[bonus_total_line]])[0]
+    if total_line < len(starts):
+        receipt.total = line_price(total_line)
+        receipt.total_conf = float(conf_arr[ends[total_line]])
+        receipt.price_boxes["total"] = price_boxes([ends[total_line]])[0]
+    return receipt
+
+
+def read_price(engine, image, box, timeout=0):
+    """Read a single price again from its box in the image. Returns (price, conf), None if it isn't read as a price."""
+    left, top, width, height = box
+    crop = image[max(top - REOCR_PADDING, 0):top + height + REOCR_PADDING,
+                 max(left - REOCR_PADDING, 0):left + width + REOCR_PADDING]
+    ocr_out = engine.image_to_data(crop, timeout=timeout)
+    words = ocr_out[ocr_out["conf"] > 0]
+    text = "".join(words["text"].dropna()).replace("-", "")  # Bonus prices are negative on the receipt
+    if not REOCR_PRICE_RE.fullmatch(text):
+        return None
+    return ah_price(text), float(words["conf"].min())
+
+
+def reocr_prices(receipt, image, timeout=0):
+    """Read the low confidence prices of a receipt that doesn't add up again with single price OCR.
+
+    Only small crops around the prices are read. Every combination of old and new prices is tried, starting with the
+    fewest changes, and the one where the most totals add up is kept. Returns True if any price was changed.
+    """
+    candidates = receipt.low_conf_prices(REOCR_CONF)[:REOCR_MAX_PRICES]
+    changes = []  # (kind, index, new price, new conf)
+    with metrics.stage("reocr_prices"):
+        with ocr_engine("price") as engine:
+            for conf, kind, index, box in candidates:
+                new = read_price(engine, image, box, timeout=timeout)
+                if new is not None and new[0] != receipt.price(kind, index)[0]:
+                    changes.append((kind, index) + new)
+        base = {"item": sum(receipt.item_prices), "bonus_item": sum(receipt.bonus_prices), "subtotal": receipt.subtotal,
+                "bonus": receipt.bonus, "total": receipt.total}
+        best_score = sum(receipt.verify.values())
+        best_changes = ()
+        for nr_changes in range(1, len(changes) + 1):
+            for combination in itertools.combinations(changes, nr_changes):
+                values = dict(base)
+                for kind, index, price, conf in combination:
+                    if kind in ("item", "bonus_item"):
+                        values[kind] += price - receipt.price(kind, index)[0]
+                    else:
+                        values[kind] = price
+                score = sum(Receipt.check_totals(values["item"], values["bonus_item"], len(receipt.bonus_prices),
+                                                 values["subtotal"], values["bonus"], values["total"]).values())
+                if score > best_score:
+                    best_score = score
+                    best_changes = combination
+            if best_score == len(receipt.verify):  # Everything adds up, no need to try more changes
+                break
+    for kind, index, price, conf in best_changes:
+        label = kind if index is None else f"{kind}_{index}"
+        print(f"Read price of {label} again: {receipt.price(kind, index)[0]} -> {price}")  # TODO log this
+        receipt.set_price(kind, index, price, conf)
+    metrics.inc("reocr_total", result="changed" if best_changes else "unchanged")
+    return len(best_changes) > 0
+
+
+def process_receipt(pdf, supermarket, participants, cache=None, timeout=0, strips=1, products=None):
+    """Parse a receipt pdf and return a Receipt object with all information. Tall receipts are OCRed in up to strips parallel parts.
+    With a ProductDictionary as products the item texts are snapped to known product names."""
     # Create instance of receipt
     receipt = Receipt(supermarket=supermarket, participants=participants)
-    # Read receipt
-    image = img_from_pdf(pdf)
-    df = receipt_ocr(image)
-
-    parse_stage = "start"
-    bonuskaart_skip = False
-    grouped = df.groupby(["global_line"])
-    for name, df_group in grouped:  # Loop over lines
-        if parse_stage == "start":
-            parse_stage = parse_start(name, df_group)
-        elif parse_stage == "parse_items":
-            bonuskaart_skip, parse_stage, receipt = parse_items(bonuskaart_skip, name, df_group, receipt)
-        elif parse_stage == "parse_bonus":
-            parse_stage, receipt = parse_bonus(name, df_group, receipt)
-        elif parse_stage == "parse_total":
-            parse_stage, receipt = parse_total(name, df_group, receipt)
-
-    receipt.merge_items()
-    receipt.verify_prices()
+    # Read receipt, OCR is only needed for image only pdfs that were not read before
+    with metrics.stage("pdf_open"):
+        doc = open_pdf(pdf)
+        check_pdf(doc)
+    with metrics.stage("text_layer"):
+        df = text_from_pdf(doc)
+    image = None
+    text_layer = df is not None
+    if text_layer:
+        metrics.inc("text_layer_total")
+    elif cache is not None:
+        with metrics.stage("cache_lookup"):
+            cache_key = cache.key(pdf, ocr_version(), OCR_LANG, OCR_CONFIG, sorted(PREPROCESS.items()), strips)
+            df = cache.get(cache_key)
+        metrics.inc("ocr_cache_total", result="miss" if df is None else "hit")
+        if df is None:
+            image = img_from_pdf(doc, preprocess=PREPROCESS)
+            df = receipt_ocr(image, timeout=timeout, strips=strips)
+            cache.put(cache_key, df)
+    else:
+        image = img_from_pdf(doc, preprocess=PREPROCESS)
+        df = receipt_ocr(image, timeout=timeout, strips=strips)
+    metrics.observe("ocr_words", len(df))
+
+    with metrics.stage("parse"):
+        parse_lines(df, receipt)
+    with metrics.stage("verify_prices"):
+        receipt.verify_prices()
+    if not text_layer and not all(receipt.verify.values()) and receipt.low_conf_prices(REOCR_CONF):
+        if image is None:  # Words came from the cache
+            image = img_from_pdf(doc, preprocess=PREPROCESS)
+        if reocr_prices(receipt, image, timeout=timeout):
+            receipt.verify_prices()
+    with metrics.stage("products"):
+        if products is not None:  # Only names of receipts that add up are learned, they were parsed right
+            products.normalize(receipt, learn=all(receipt.verify.values()))
+        link_bonus_items(receipt)
     return receipt
 
 
@@ -0,0 +1,249 @@
+import decimal
+import time
+
+from flask import jsonify, request
+from werkzeug.utils import secure_filename
+
+from app import app, metrics
+from app.jobs import ClientQueueFull, QueueFull
+from app.receipt import Receipt
+from app.routes import (CLIENT_BUSY_RETRY, OCR_JOBS, RECEIPTS, SUPERMARKETS, allowed_file, get_ip, parse_users,
+                        process_form, remove_upload, save_upload, share_form, upload_rate_limited)
+from app.settlement import Settlement
+from app.splitter import from_cents, to_cents
+
+API_PREFIX = "/api/v1"
+MAX_BULK_RECEIPTS = min(app.config['UPLOAD_BURST'], app.config['OCR_JOBS_PER_CLIENT'])  # More would always be refused
+WAIT_INTERVAL = 0.1  # Seconds between job status checks while a request waits for its OCR job
+
+
+def api_error(message, status_code):
+    """Return JSON error response."""
+    return jsonify(error=message), status_code
+
+
+def job_result(job_id):
+    """Return the state of an OCR job as dict, with the parsed receipt when it is done."""
+    status, token, error = OCR_JOBS.get(job_id)
+    result = {"job_id": job_id, "status": status}
+    if status == "failed":
+        print(f"OCR job {job_id} failed: {error}")  # TODO log this
+        result["error"] = "Receipt could not be read"
+    elif status == "done":
+        receipt = RECEIPTS.get(token)
+        if receipt is None:
+            result["status"] = "expired"
+        else:
+            result["token"] = token
+            result["receipt"] = receipt.to_dict()
+    return result
+
+
+def wait_for_jobs(job_ids, wait):
+    """Wait at most wait seconds until all jobs are finished."""
+    deadline = time.monotonic() + min(wait, app.config['API_MAX_WAIT'])  # uWSGI kills workers that wait too long
+    pending = set(job_ids)
+    while pending and time.monotonic() < deadline:
+        pending = {job_id for job_id in pending if OCR_JOBS.status(job_id) not in ("done", "failed", None)}
+        if pending:
+            time.sleep(WAIT_INTERVAL)
+
+
+def upload_error(files):
+    """Return error message if the upload request is not valid, None if it is."""
+    if request.form.get("supermarket", "AH") not in SUPERMARKETS:
+        return f"Unknown supermarket, choose from {sorted(SUPERMARKETS)}"
+    try:
+        float(request.args.get("wait", 0))
+    except ValueError:
+        return "wait must be a number of seconds"
+    if len(files) == 0:
+        return "No receipt pdf uploaded"
+    for input_pdf in files:
+        if not allowed_file(secure_filename(input_pdf.filename or "")):
+            return f"Not a pdf: {input_pdf.filename}"
+    return None
+
+
+def submit_receipts(files):
+    """Submit OCR jobs for uploaded receipt pdfs and return their results, waiting for them if ?wait= is given.
+
+    Raises ReceiptError if a pdf is refused, none of the receipts are submitted then.
+    """
+    supermarket = request.form.get("supermarket", "AH")
+    users = parse_users(request.form)
+    ip = get_ip()
+    pdf_paths = []
+    job_ids = []
+    try:
+        for input_pdf in files:
+            pdf_paths.append(save_upload(input_pdf))
+        # All receipts are submitted at once, so a full queue refuses all of them instead of leaving some running
+        job_ids = OCR_JOBS.submit_many([(pdf_path, supermarket, users) for pdf_path in pdf_paths], client=ip)
+    except BaseException:
+        for pdf_path in pdf_paths[len(job_ids):]:  # Submitted jobs remove their own upload
+            remove_upload(pdf_path)
+        raise
+    wait = float(request.args.get("wait", 0))
+    if wait > 0:
+        wait_for_jobs(job_ids, wait)
+    results = [job_result(job_id) for job_id in job_ids]
+    pending = any(result["status"] in ("queued", "running") for result in results)
+    return results, 202 if pending else 200
+
+
+def too_many_requests(retry_after):
+    """Return 429 response for clients that upload too fast."""
+    return jsonify(error="Too many uploads, try again later"), 429, {"Retry-After": str(retry_after)}
+
+
+def refused_upload(e):
+    """Return error response for receipts that were not submitted because of exception e."""
+    if isinstance(e, ClientQueueFull):
+        metrics.inc("admission_total", result="client_busy")
+        return jsonify(error="Too many of your receipts are still being read"), 429, {"Retry-After": str(CLIENT_BUSY_RETRY)}
+    if isinstance(e, QueueFull):
+        metrics.inc("admission_total", result="queue_full")
+        return api_error("Too many receipts in the queue, try again later", 503)
+    return api_error(f"Receipt refused: {e}", 400)
+
+
+@app.route(f'{API_PREFIX}/receipt', methods=['POST'])
+def api_receipt():
+    """Read one receipt pdf uploaded as "file". Returns 202 with the job when it isn't done within ?wait= seconds."""
+    retry_after = upload_rate_limited(get_ip())  # Checked before the upload is read
+    if retry_after:
+        return too_many_requests(retry_after)
+    files = request.files.getlist("file")[:1]
+    error = upload_error(files)
+    if error is not None:
+        return api_error(error, 400)
+    from app.ah_bon_OCR import ReceiptError  # Only uploads need the OCR libraries
+    try:
+        results, status_code = submit_receipts(files)
+    except (ReceiptError, QueueFull) as e:
+        return refused_upload(e)
+    metrics.inc("admission_total", len(files), result="admitted")
+    headers = {"Location": f"{API_PREFIX}/jobs/{results[0]['job_id']}"} if status_code == 202 else {}
+    return jsonify(results[0]), status_code, headers
+
+
+@app.route(f'{API_PREFIX}/receipts', methods=['POST'])
+def api_receipts():
+    """Read several receipt pdfs uploaded as "files" in one request, at most MAX_BULK_RECEIPTS."""
+    retry_after = upload_rate_limited(get_ip())  # Checked before the upload is read
+    if retry_after:
+        return too_many_requests(retry_after)
+    files = request.files.getlist("files")
+    error = upload_error(files)
+    if error is not None:
+        return api_error(error, 400)
+    if len(files) > MAX_BULK_RECEIPTS:
+        return api_error(f"Too many receipts, upload at most {MAX_BULK_RECEIPTS} per request", 400)
+    if len(files) > 1:
+        retry_after = upload_rate_limited(get_ip(), len(files) - 1)  # Every receipt takes a token
+        if retry_after:
+            return too_many_requests(retry_after)
+    from app.ah_bon_OCR import ReceiptError  # Only uploads need the OCR libraries
+    try:
+        results, status_code = submit_receipts(files)
+    except (ReceiptError, QueueFull) as e:
+        return refused_upload(e)
+    metrics.inc("admission_total", len(files), result="admitted")
+    return jsonify(results=results), status_code
+
+
+@app.route(f'{API_PREFIX}/jobs/<job_id>', methods=['GET'])
+def api_job(job_id):
+    result = job_result(job_id)
+    if result["status"] is None:
+        return api_error("Job not found", 404)
+    return jsonify(result)
+
+
+@app.route(f'{API_PREFIX}/receipts/<token>', methods=['GET'])
+def api_stored_receipt(token):
+    receipt = RECEIPTS.get(token)
+    if receipt is None:
+        return api_error("Receipt not found or expired", 404)
+    return jsonify(token=token, receipt=receipt.to_dict())
+
+
+def split_receipt(split_request):
+    """Split a stored receipt ("token") or an inline receipt ("receipt") with the given "shares" and "prices"."""
+    if "token" in split_request:
+        receipt = RECEIPTS.get(split_request["token"])
+        if receipt is None:
+            return {"error": "Receipt not found or expired"}
+    elif "receipt" in split_request:
+        receipt = Receipt.from_dict(split_request["receipt"])
+    else:
+        return {"error": "Give a receipt token or an inline receipt"}
+    if "participants" in split_request:
+        receipt.participants = list(split_request["participants"])
+    if len(receipt.participants) == 0:
+        return {"error": "Receipt has no participants"}
+    receipt_form = share_form(receipt, split_request.get("shares", {}))
+    receipt_form.update(split_request.get("prices", {}))  # Corrected prices, with the form keys ("item_0", "total")
+    receipt_dic, error = process_form(receipt, receipt_form)
+    return {
+        "user_totals": {user: str(total) for user, total in receipt_dic["user_totals"].items()},
+        "subtotal": str(receipt_dic["subtotal"]),
+        "bonus": str(receipt_dic["bonus"]),
+        "total": str(receipt_dic["total"]),
+        "totals_match": not error,
+    }
+
+
+@app.route(f'{API_PREFIX}/split', methods=['POST'])
+def api_split():
+    """Split one receipt, or several when the body has a "receipts" list."""
+    split_request = request.get_json(silent=True)
+    if not isinstance(split_request, dict):
+        return api_error("Expected a JSON object", 400)
+    bulk = "receipts" in split_request
+    split_requests = split_request["receipts"] if bulk else [split_request]
+    results = []
+    with metrics.stage("split"):
+        for cur_request in split_requests:
+            try:
+                results.append(split_receipt(cur_request))
+            except (KeyError, TypeError, ValueError, AttributeError, decimal.InvalidOperation) as e:
+                results.append({"error": f"Invalid split request: {type(e).__name__}: {e}"})
+    if bulk:
+        return jsonify(results=results)
+    if "error" in results[0]:
+        return api_error(results[0]["error"], 400)
+    return jsonify(results[0])
+
+
+@app.route(f'{API_PREFIX}/settle', methods=['POST'])
+def api_settle():
+    """Combine many receipts and return the balances and the transfers that settle them.
+
+    Every entry of "receipts" has "paid_by" and either "user_totals" ({user: price}) or a split request like /split.
+    """
+    settle_request = request.get_json(silent=True)
+    if not isinstance(settle_request, dict) or not isinstance(settle_request.get("receipts"), list):
+        return api_error("Expected a JSON object with a receipts list", 400)
+    settlement = Settlement()
+    results = []
+    with metrics.stage("settle"):
+        for cur_request in settle_request["receipts"]:
+            try:
+                if "user_totals" in cur_request:
+                    result = {"user_totals": cur_request["user_totals"]}
+                else:
+                    result = split_receipt(cur_request)
+                if "error" not in result:
+                    settlement.add(cur_request["paid_by"],
+                                   {user: to_cents(total) for user, total in result["user_totals"].items()})
+            except (KeyError, TypeError, ValueError, AttributeError, decimal.InvalidOperation) as e:
+                result = {"error": f"Invalid receipt: {type(e).__name__}: {e}"}
+            results.append(result)
+    if any("error" in result for result in results):
+        return jsonify(error="Not all receipts could be split", results=results), 400
+    transfers = [{"from": from_user, "to": to_user, "amount": str(from_cents(cents))}
+                 for from_user, to_user, cents in settlement.transfers()]
+    balances = {user: str(from_cents(cents)) for user, cents in settlement.balances.items()}
+    return jsonify(balances=balances, transfers=transfers, results=results)
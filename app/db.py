@@ -0,0 +1,37 @@
+import contextlib
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """Base class for stores backed by a SQLite database that is shared by all worker processes."""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+    def connect(self):
+        """Return SQLite connection of the current thread."""
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:  # Connections can't be shared between threads or forked processes
+            db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+            self._local.pid = pid
+        return self._local.db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run statements in a write transaction that locks out other writers from the start, so what is read in it
+        stays current until it is committed. Rolled back on any exception."""
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
@@ -0,0 +1,159 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from app.db import SQLiteStore
+
+
+class QueueFull(Exception):
+    """Raised when the job queue has reached its max depth."""
+
+
+class ClientQueueFull(QueueFull):
+    """Raised when a client has reached its max number of queued and running jobs."""
+
+
+class JobQueue(SQLiteStore):
+    """Job queue backed by SQLite, jobs can be submitted and polled from every worker process.
+
+    Every process that uses the queue runs its own pool of background threads that take jobs from the
+    shared queue, so a job submitted to one uWSGI worker can be processed and polled by any other worker.
+    """
+    def __init__(self, db_path, handler, workers, max_depth, timeout, max_age, poll_interval=0.5, max_client_depth=None):
+        super().__init__(db_path)
+        self.handler = handler  # Function that is called with the job payload and returns the job result
+        self.workers = workers  # Number of worker threads per process
+        self.max_depth = max_depth  # Max number of queued and running jobs
+        self.max_client_depth = max_client_depth  # Max number of queued and running jobs per client, None for no limit
+        self.timeout = timeout  # Max runtime of a job in seconds
+        self.max_age = max_age  # Seconds to keep finished jobs around for polling
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker_pid = None
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                payload BLOB,
+                result BLOB,
+                error TEXT)""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            if "client" not in {column[1] for column in db.execute("PRAGMA table_info(jobs)")}:  # Added later
+                db.execute("ALTER TABLE jobs ADD COLUMN client TEXT")
+
+    def start_workers(self):
+        """Start the worker threads of this process if they are not running yet."""
+        with self._lock:
+            if self._worker_pid == os.getpid():  # Threads do not survive a fork, check pid
+                return
+            self._worker_pid = os.getpid()
+            for _ in range(self.workers):
+                threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, payload, client=None):
+        """Add a job to the queue and return its id. Raises QueueFull when the queue is full, ClientQueueFull when the
+        client (e.g. an ip address) already has the max number of jobs."""
+        return self.submit_many([payload], client)[0]
+
+    def submit_many(self, payloads, client=None):
+        """Add jobs to the queue at once and return their ids. Either all jobs are added or none: raises QueueFull or
+        ClientQueueFull when they don't all fit."""
+        self.start_workers()
+        job_ids = [uuid.uuid4().hex for _ in payloads]
+        now = time.time()
+        with self.transaction() as db:
+            self.expire(db, now)
+            depth = db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+            if depth + len(payloads) > self.max_depth:
+                raise QueueFull
+            if client is not None and self.max_client_depth is not None:
+                client_depth = db.execute("SELECT COUNT(*) FROM jobs WHERE client = ? AND status IN ('queued', 'running')",
+                                          (client,)).fetchone()[0]
+                if client_depth + len(payloads) > self.max_client_depth:
+                    raise ClientQueueFull
+            db.executemany("INSERT INTO jobs (id, status, created, payload, client) VALUES (?, 'queued', ?, ?, ?)",
+                           [(job_id, now, pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL), client)
+                            for job_id, payload in zip(job_ids, payloads)])
+        self._wakeup.set()  # Wake up a local worker, workers of other processes pick it up on their next poll
+        return job_ids
+
+    def status(self, job_id):
+        """Return status of a job, None for unknown jobs."""
+        self.start_workers()
+        db = self.connect()
+        with db:
+            self.expire(db, time.time())
+        row = db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get(self, job_id):
+        """Return status, result and error of a job. Status is None for unknown jobs."""
+        self.start_workers()
+        db = self.connect()
+        with db:
+            self.expire(db, time.time())
+        row = db.execute("SELECT status, result, error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None, None, None
+        status, result, error = row
+        if result is not None:
+            result = pickle.loads(result)
+        return status, result, error
+
+    def expire(self, db, now):
+        """Fail jobs that exceeded the timeout and remove old finished jobs."""
+        db.execute("UPDATE jobs SET status = 'failed', finished = ?, payload = NULL, error = 'timeout' "
+                   "WHERE status = 'running' AND started < ?", (now, now - self.timeout))
+        db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (now - self.max_age,))
+        # Jobs that wait longer than max_age are never going to be picked up in time
+        db.execute("DELETE FROM jobs WHERE status = 'queued' AND created < ?", (now - self.max_age,))
+
+    def claim(self):
+        """Take the oldest queued job, return its id and payload or None if the queue is empty."""
+        with self.transaction() as db:
+            row = db.execute("SELECT id, payload FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), row[0]))
+        if row is None:
+            return None
+        return row[0], pickle.loads(row[1])
+
+    def work(self):
+        """Worker thread loop, process jobs until the process exits."""
+        while True:
+            try:
+                job = self.claim()
+            except sqlite3.OperationalError:  # Database is locked by a busy worker, try again later
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            job_id, payload = job
+            try:
+                try:
+                    result = self.handler(payload)
+                except Exception as e:
+                    print(traceback.format_exc())  # TODO log this
+                    self.finish(job_id, "failed", error=str(e))
+                else:
+                    self.finish(job_id, "done", result=pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+            except Exception:  # Outcome could not be stored, e.g. database is locked. The job times out, keep working
+                print(traceback.format_exc())  # TODO log this
+
+    def finish(self, job_id, status, result=None, error=None):
+        """Store outcome of a job. Jobs that already timed out are left alone."""
+        db = self.connect()
+        with db:
+            db.execute("UPDATE jobs SET status = ?, finished = ?, payload = NULL, result = ?, error = ? "
+                       "WHERE id = ? AND status = 'running'", (status, time.time(), result, error, job_id))
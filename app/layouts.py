@@ -0,0 +1,16 @@
+LAYOUTS = {  # Receipt layout per supermarket, the OCR words are classified with these tables by ah_bon_OCR.Tokenizer
+    "AH": {
+        "keywords": {  # Word: token kind, lines with these words start a new section of the receipt
+            "AANTAL": "start",  # Header of the item table
+            "OMSCHRIJVING": "start",
+            "PRIJS": "start",
+            "BEDRAG": "start",
+            "BONUSKAART": "bonuskaart",  # Line with the bonus card number, between the items
+            "SUBTOTAAL": "subtotal",
+            "VOORDEEL": "bonus_total",
+            "TOTAAL": "total",
+        },
+        "bonus_ids": ["B", "35%"],  # Bonus and 35% discount markers behind the price of an item, first match wins
+        "bonus_text_remove": ["BONUS", "35% K"],  # Removed from the text of bonus items
+    },
+}
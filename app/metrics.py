@@ -0,0 +1,141 @@
+import contextlib
+import os
+import threading
+import time
+import tracemalloc
+
+ENABLED = False  # Recording is off by default, stage() and observe() are no-ops then
+PREFIX = "bon_splitser"
+HISTOGRAMS = {  # name: (help, bucket upper bounds)
+    "stage_duration_seconds": ("Duration of processing stages", (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    "image_width_pixels": ("Width of receipt images", (250, 500, 1000, 2000, 4000)),
+    "image_height_pixels": ("Height of receipt images", (500, 1000, 2000, 4000, 8000, 16000)),
+    "ocr_words": ("Number of words read from a receipt", (25, 50, 100, 200, 400, 800, 1600)),
+    "peak_memory_bytes": ("Peak memory allocated by Python and numpy during a stage",
+                          (1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8)),
+}
+COUNTERS = {  # name: help
+    "ocr_cache_total": "OCR cache lookups",
+    "text_layer_total": "Receipts read from the pdf text layer instead of OCR",
+    "admission_total": "Upload admission decisions, uploads that are not admitted are refused with a 429 or 503",
+    "product_lookup_total": "Item names that were snapped to a known product or are new",
+    "reocr_total": "Receipts with prices that were read again because the totals didn't add up",
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels): [bucket counts, sum, count]
+_counters = {}  # (name, labels): value
+_null_stage = contextlib.nullcontext()
+
+
+def enable(enabled=True):
+    """Turn recording of metrics on or off."""
+    global ENABLED
+    ENABLED = enabled
+
+
+def observe(name, value, **labels):
+    """Add a value to a histogram."""
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    buckets = HISTOGRAMS[name][1]
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(buckets), 0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def inc(name, amount=1, **labels):
+    """Increase a counter."""
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+class _Stage:
+    """Context manager that records the duration of a stage."""
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe("stage_duration_seconds", time.perf_counter() - self.start, stage=self.name)
+
+
+def stage(name):
+    """Return context manager that times a processing stage."""
+    if not ENABLED:
+        return _null_stage
+    return _Stage(name)
+
+
+class _Memory:
+    """Context manager that records the peak memory allocated during a stage with tracemalloc."""
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc_info):
+        observe("peak_memory_bytes", tracemalloc.get_traced_memory()[1] - self.start, stage=self.name)
+
+
+def memory(name):
+    """Return context manager that records the peak memory of a stage. Allocations of all threads are counted and
+    tracemalloc slows down allocations, so this is only done when metrics are enabled."""
+    if not ENABLED:
+        return _null_stage
+    return _Memory(name)
+
+
+def format_labels(labels):
+    """Format labels in Prometheus text format."""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def render():
+    """Return all metrics of this worker in Prometheus text format."""
+    worker = (("worker", str(os.getpid())),)
+    lines = []
+    with _lock:
+        histograms = {key: (list(counts), total, count) for key, (counts, total, count) in _histograms.items()}
+        counters = dict(_counters)
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} histogram")
+        for (hist_name, labels), (counts, total, count) in sorted(histograms.items()):
+            if hist_name != name:
+                continue
+            labels = worker + labels
+            for bound, bucket_count in zip(buckets, counts):
+                lines.append(f"{PREFIX}_{name}_bucket{format_labels(labels + (('le', str(bound)),))} {bucket_count}")
+            lines.append(f"{PREFIX}_{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{PREFIX}_{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{PREFIX}_{name}_count{format_labels(labels)} {count}")
+    for name, help_text in COUNTERS.items():
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"{PREFIX}_{name}{format_labels(worker + labels)} {value}")
+    return "\n".join(lines) + "\n"
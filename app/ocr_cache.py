@@ -0,0 +1,91 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+class OCRCache:
+    """Content-addressed on-disk cache for OCR results. Safe to share between worker processes."""
+    def __init__(self, cache_dir, max_size, max_age):
+        self.cache_dir = cache_dir
+        self.max_size = max_size  # Max total size of the cache in bytes
+        self.max_age = max_age  # Max age of a cache entry in seconds
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, pdf, *params):
+        """Return cache key for the pdf (bytes or file path) and the OCR parameters used to read it."""
+        if isinstance(pdf, (bytes, bytearray, memoryview)):
+            key_hash = hashlib.sha256(pdf)
+        else:  # Hash the file in chunks, it doesn't have to be read into memory
+            key_hash = hashlib.sha256()
+            with open(pdf, "rb") as pdf_f:
+                for chunk in iter(lambda: pdf_f.read(HASH_CHUNK_SIZE), b""):
+                    key_hash.update(chunk)
+        for param in params:
+            key_hash.update(f"\0{param}".encode())
+        return key_hash.hexdigest()
+
+    def path(self, key):
+        """Return file path of a cache entry."""
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get(self, key):
+        """Return cached OCR result or None on a cache miss."""
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)  # Entry expired
+                return None
+            with open(path, "rb") as cache_f:
+                result = pickle.load(cache_f)
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:  # Missing, or evicted by another worker
+            return None
+        except Exception as e:  # Truncated entry, or pickled by another pandas version
+            print(f"Removing unreadable OCR cache entry {key}: {type(e).__name__}: {e}")  # TODO log this
+            self.remove(path)
+            return None
+        return result
+
+    def put(self, key, result):
+        """Store OCR result in the cache and evict old entries."""
+        # Write to a temp file first so other workers never read a half written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as cache_f:
+            pickle.dump(result, cache_f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """Remove expired entries, then least recently used entries until the cache fits in max_size."""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".pkl"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # Removed by another worker
+                continue
+            if now - stat.st_mtime > self.max_age:
+                self.remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for mtime, size, path in entries)
+        entries.sort()  # Oldest first
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            self.remove(path)
+            total_size -= size
+
+    @staticmethod
+    def remove(path):
+        """Remove a cache entry, ignore it if another worker already removed it."""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,211 @@
+import math
+import re
+import threading
+import time
+
+from app import metrics
+from app.db import SQLiteStore
+
+MIN_SIMILARITY = 0.8  # Min trigram similarity to snap an OCR'd name to a known product
+MIN_NAME_LENGTH = 4  # Shorter names have too few trigrams to match reliably, they are left as they are
+LINK_MIN_SIMILARITY = 0.3  # Min trigram similarity to link a bonus item to the item it discounts
+EVICT_FRACTION = 0.1  # Part of the dictionary that is removed at once when it is full, every eviction reloads the indexes
+ITEM_TEXT_RE = re.compile(r"^(\s*(?:\d+\s+)?)(.*?)\s*$")  # Quantity before the product name of an item text
+AMOUNT_RE = re.compile(r"(?<!\S)\d+")  # Numbers at the start of a word, like the size in "MELK 1L"
+
+
+def compact(name):
+    """Return the key a name is compared by, OCR often drops or adds spaces so they are ignored."""
+    return "".join(name.split()).upper()
+
+
+def trigrams(key):
+    """Return set of trigrams of a compact key, padded so short keys and their first letters count too."""
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(grams, other_grams):
+    """Dice similarity of two trigram sets, 1 for the same set and 0 when nothing is shared."""
+    if not grams or not other_grams:
+        return 0
+    return 2 * len(grams & other_grams) / (len(grams) + len(other_grams))
+
+
+def amounts(name):
+    """Return the numbers that start a word of the name, names with other sizes or amounts are other products."""
+    return tuple(AMOUNT_RE.findall(name.upper()))
+
+
+def split_item_text(item_text):
+    """Split an item text into the quantity prefix (with its spaces) and the product name."""
+    match = ITEM_TEXT_RE.match(item_text)
+    return match.group(1), match.group(2)
+
+
+class TrigramIndex:
+    """In-memory trigram index of product names, finds the most similar name without comparing against all of them."""
+    def __init__(self):
+        self.names = {}  # Name id: name
+        self.keys = {}  # Compact key: name id, for exact lookups
+        self.grams = {}  # Name id: trigrams
+        self.amounts = {}  # Name id: amounts in the name
+        self.postings = {}  # Trigram: ids of the names that contain it
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name_id, name):
+        """Add a name to the index, names with the same compact key as a known name are skipped."""
+        key = compact(name)
+        if key in self.keys:
+            return
+        self.names[name_id] = name
+        self.keys[key] = name_id
+        self.grams[name_id] = grams = trigrams(key)
+        self.amounts[name_id] = amounts(name)
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(name_id)
+
+    def lookup(self, name, min_similarity):
+        """Return (name id, similarity) of the most similar name, None if no name is at least min_similarity similar.
+
+        Only names that share a trigram with the rarest trigrams of the query are compared: a name that shares enough
+        trigrams to be similar can miss at most len(grams) - min_shared of them, so it must share one of the rest.
+        """
+        key = compact(name)
+        if key in self.keys:
+            return self.keys[key], 1.0
+        grams = trigrams(key)
+        # Dice >= min_similarity needs 2 * shared >= min_similarity * (len(grams) + shared)
+        min_shared = max(1, math.ceil(min_similarity * len(grams) / (2 - min_similarity) - 1e-9))
+        if min_shared > len(grams):
+            return None
+        rarest = sorted(grams, key=lambda gram: len(self.postings.get(gram, ())))[:len(grams) - min_shared + 1]
+        candidates = set()
+        for gram in rarest:
+            candidates.update(self.postings.get(gram, ()))
+        name_amounts = amounts(name)
+        max_grams = len(grams) * (2 - min_similarity) / min_similarity  # Longer names can't be similar enough
+        best = None
+        for name_id in candidates:
+            other_grams = self.grams[name_id]
+            if not min_shared <= len(other_grams) <= max_grams or self.amounts[name_id] != name_amounts:
+                continue
+            score = similarity(grams, other_grams)
+            if score >= min_similarity and (best is None or score > best[1]):
+                best = (name_id, score)
+        return best
+
+
+class ProductDictionary(SQLiteStore):
+    """Persistent, bounded dictionary of the product names seen on receipts, used to snap OCR'd item texts to known names.
+
+    The names are stored in SQLite, so they are shared by all worker processes and survive restarts. Every process keeps
+    a trigram index per supermarket in memory, it is updated with the new names when PRAGMA data_version shows that
+    another connection changed the database and rebuilt after names were evicted. When there are more than max_products
+    names the least recently seen are evicted.
+    """
+    def __init__(self, db_path, max_products, min_similarity=MIN_SIMILARITY):
+        super().__init__(db_path)
+        self.max_products = max_products
+        self.min_similarity = min_similarity
+        self._lock = threading.Lock()  # Guards the indexes, they are shared by the threads of a process
+        self._indexes = {}  # Supermarket: TrigramIndex
+        self._max_id = 0  # Highest name id in the indexes
+        self._evictions = None  # Number of evictions when the indexes were built
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY,
+                supermarket TEXT NOT NULL,
+                name TEXT NOT NULL,
+                seen INTEGER NOT NULL,
+                updated REAL NOT NULL,
+                UNIQUE (supermarket, name))""")
+            db.execute("CREATE INDEX IF NOT EXISTS products_updated ON products (updated)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('evictions', 0)")
+
+    def refresh(self, force=False):
+        """Load names added by other connections into the indexes, rebuild them if names were evicted.
+
+        Call with the lock held. Commits of the own connection don't change its data_version, so force after writing.
+        """
+        db = self.connect()
+        data_version = (db, db.execute("PRAGMA data_version").fetchone()[0])  # Only comparable on the same connection
+        if data_version == getattr(self._local, "data_version", None) and not force:
+            return
+        self._local.data_version = data_version
+        evictions = db.execute("SELECT value FROM meta WHERE key = 'evictions'").fetchone()[0]
+        if evictions != self._evictions:
+            self._indexes = {}
+            self._max_id = 0
+            self._evictions = evictions
+        rows = db.execute("SELECT id, supermarket, name FROM products WHERE id > ? ORDER BY id", (self._max_id,))
+        for name_id, supermarket, name in rows:
+            self._indexes.setdefault(supermarket, TrigramIndex()).add(name_id, name)
+            self._max_id = name_id
+
+    def snap(self, supermarket, names):
+        """Return (known name or None, name id or None) for every name."""
+        with self._lock:
+            self.refresh()
+            index = self._indexes.get(supermarket)
+            snapped = []
+            for name in names:
+                match = None
+                if index is not None and len(compact(name)) >= MIN_NAME_LENGTH:
+                    match = index.lookup(name, self.min_similarity)
+                snapped.append((None, None) if match is None else (index.names[match[0]], match[0]))
+            return snapped
+
+    def normalize(self, receipt, learn=True):
+        """Snap the item and bonus texts of the receipt to known product names. With learn the item names that are not
+        known yet are added to the dictionary, and the known ones are marked as seen."""
+        prefixes, names = zip(*map(split_item_text, receipt.item_texts)) if receipt.item_texts else ((), ())
+        item_matches = self.snap(receipt.supermarket, names)
+        for i, (prefix, (known_name, name_id)) in enumerate(zip(prefixes, item_matches)):
+            if known_name is not None:
+                receipt.set_text("item", i, f"{prefix}{known_name}")
+        for i, (known_name, name_id) in enumerate(self.snap(receipt.supermarket, receipt.bonus_texts)):
+            if known_name is not None:
+                receipt.set_text("bonus_item", i, known_name)
+        for known_name, name_id in item_matches:
+            metrics.inc("product_lookup_total", result="new" if known_name is None else "known")
+        if learn:
+            new_names = [name for name, (known_name, name_id) in zip(names, item_matches)
+                         if known_name is None and len(compact(name)) >= MIN_NAME_LENGTH]
+            self.learn(receipt.supermarket, new_names, [name_id for known_name, name_id in item_matches if name_id is not None])
+
+    def learn(self, supermarket, new_names, seen_ids):
+        """Add new product names, mark known names as seen and evict the least recently seen names if there are too many."""
+        if not new_names and not seen_ids:
+            return
+        now = time.time()
+        with self.transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO products (supermarket, name, seen, updated) VALUES (?, ?, 1, ?)",
+                           [(supermarket, name, now) for name in new_names])
+            db.executemany("UPDATE products SET seen = seen + 1, updated = ? WHERE id = ?",
+                           [(now, name_id) for name_id in seen_ids])
+            nr_products = db.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+            if nr_products > self.max_products:  # Evict a batch at once, every eviction makes all processes reload
+                nr_evict = nr_products - self.max_products + math.ceil(self.max_products * EVICT_FRACTION)
+                db.execute("DELETE FROM products WHERE id IN (SELECT id FROM products ORDER BY updated LIMIT ?)",
+                           (nr_evict,))
+                db.execute("UPDATE meta SET value = value + 1 WHERE key = 'evictions'")
+        if new_names:
+            with self._lock:
+                self.refresh(force=True)
+
+
+def link_bonus_items(receipt):
+    """Link every bonus item to the item with a bonus id (e.g. "B", "35%") whose text is most similar, the item it
+    discounts. Bonus items without a similar enough item are linked to None."""
+    discounted = [(i, trigrams(compact(split_item_text(item_text)[1])))
+                  for i, (item_text, bonus) in enumerate(zip(receipt.item_texts, receipt.item_bonus)) if bonus is not None]
+    links = []
+    for bonus_text in receipt.bonus_texts:
+        grams = trigrams(compact(bonus_text))
+        score, item = max(((similarity(grams, item_grams), i) for i, item_grams in discounted), default=(0, None))
+        links.append(item if score >= LINK_MIN_SIMILARITY else None)
+    receipt.bonus_links = links
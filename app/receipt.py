@@ -0,0 +1,192 @@
+import decimal
+
+
+class Receipt:
+    ITEM_COLUMNS = ["price", "price_conf", "bonus", "item_text"]
+    PRICE_KEYS = ["subtotal", "bonus", "total"]
+    BONUS_ITEM_COLUMNS = ["price", "price_conf", "bonus_text"]
+
+    def __init__(self, supermarket, participants):
+        self.supermarket = supermarket
+        self.participants = participants
+        self.subtotal = 0
+        self.subtotal_conf = None
+        self.bonus = 0
+        self.bonus_conf = None
+        self.total = 0
+        self.total_conf = None
+        self.price_boxes = {}  # Position in the image of the subtotal, bonus and total, as (left, top, width, height)
+        # Items are stored column wise in lists, dataframes are only built when requested
+        self.item_prices = []
+        self.item_confs = []
+        self.item_bonus = []
+        self.item_texts = []
+        self.item_boxes = []  # Position of the price in the image, None when unknown
+        self.bonus_prices = []
+        self.bonus_confs = []
+        self.bonus_texts = []
+        self.bonus_boxes = []
+        self.bonus_links = []  # Index of the item a bonus item discounts, None when unknown
+        self._items_df = None
+        self._bonus_items_df = None
+        self.verify = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_items_df"] = None  # Don't store dataframes, they can be rebuilt from the lists
+        state["_bonus_items_df"] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("bonus_links", [None] * len(state["bonus_prices"]))  # Receipts stored before bonus items were linked
+        self.__dict__.update(state)
+
+    def add_item(self, price, price_conf, bonus, item_text, price_box=None):
+        """Add item to receipt."""
+        self.add_items([price], [price_conf], [bonus], [item_text], [price_box])
+
+    def add_items(self, prices, price_confs, bonus, item_texts, price_boxes=None):
+        """Add multiple items to receipt."""
+        self.item_prices.extend(prices)
+        self.item_confs.extend(price_confs)
+        self.item_bonus.extend(bonus)
+        self.item_texts.extend(item_texts)
+        self.item_boxes.extend(price_boxes if price_boxes is not None else [None] * len(prices))
+        self._items_df = None
+
+    def add_bonus_item(self, bonus_price, price_conf, bonus_text, price_box=None):
+        """Add bonus item to receipt."""
+        self.add_bonus_items([bonus_price], [price_conf], [bonus_text], [price_box])
+
+    def add_bonus_items(self, bonus_prices, price_confs, bonus_texts, price_boxes=None, links=None):
+        """Add multiple bonus items to receipt."""
+        self.bonus_prices.extend(bonus_prices)
+        self.bonus_confs.extend(price_confs)
+        self.bonus_texts.extend(bonus_texts)
+        self.bonus_boxes.extend(price_boxes if price_boxes is not None else [None] * len(bonus_prices))
+        self.bonus_links.extend(links if links is not None else [None] * len(bonus_prices))
+        self._bonus_items_df = None
+
+    @property
+    def items(self):
+        """Dataframe of the shopping items."""
+        if self._items_df is None:
+            import pandas as pd  # Imported when needed, unpickling a receipt doesn't need pandas
+            self._items_df = pd.DataFrame(dict(zip(self.ITEM_COLUMNS, [self.item_prices, self.item_confs, self.item_bonus,
+                                                                       self.item_texts])), columns=self.ITEM_COLUMNS)
+        return self._items_df
+
+    @property
+    def bonus_items(self):
+        """Dataframe of the bonus items."""
+        if self._bonus_items_df is None:
+            import pandas as pd
+            self._bonus_items_df = pd.DataFrame(dict(zip(self.BONUS_ITEM_COLUMNS, [self.bonus_prices, self.bonus_confs,
+                                                                                   self.bonus_texts])),
+                                                columns=self.BONUS_ITEM_COLUMNS)
+        return self._bonus_items_df
+
+    def to_dict(self):
+        """Return receipt as dict that can be serialized to JSON. Prices are strings to keep them exact."""
+        def conf(value):
+            return None if value is None else float(value)
+        receipt_dict = {
+            "supermarket": self.supermarket,
+            "participants": self.participants,
+            "items": [{"item_text": item_text, "price": str(price), "price_conf": conf(price_conf), "bonus": bonus}
+                      for price, price_conf, bonus, item_text in zip(self.item_prices, self.item_confs, self.item_bonus,
+                                                                      self.item_texts)],
+            "bonus_items": [{"bonus_text": bonus_text, "price": str(price), "price_conf": conf(price_conf), "item": link}
+                            for price, price_conf, bonus_text, link in zip(self.bonus_prices, self.bonus_confs,
+                                                                           self.bonus_texts, self.bonus_links)],
+            "subtotal": str(self.subtotal),
+            "subtotal_conf": conf(self.subtotal_conf),
+            "bonus": str(self.bonus),
+            "bonus_conf": conf(self.bonus_conf),
+            "total": str(self.total),
+            "total_conf": conf(self.total_conf),
+            "verify": {key: bool(correct) for key, correct in self.verify.items()},
+        }
+        return receipt_dict
+
+    def price(self, kind, index=None):
+        """Return price and confidence of an item ("item", "bonus_item") by index, or of a total by its key."""
+        if kind == "item":
+            return self.item_prices[index], self.item_confs[index]
+        if kind == "bonus_item":
+            return self.bonus_prices[index], self.bonus_confs[index]
+        return getattr(self, kind), getattr(self, f"{kind}_conf")
+
+    def set_price(self, kind, index, price, price_conf):
+        """Correct the price of an item by index, or of a total by its key."""
+        if kind == "item":
+            self.item_prices[index] = price
+            self.item_confs[index] = price_conf
+            self._items_df = None
+        elif kind == "bonus_item":
+            self.bonus_prices[index] = price
+            self.bonus_confs[index] = price_conf
+            self._bonus_items_df = None
+        else:
+            setattr(self, kind, price)
+            setattr(self, f"{kind}_conf", price_conf)
+
+    def set_text(self, kind, index, text):
+        """Correct the text of an item ("item", "bonus_item") by index."""
+        if kind == "item":
+            self.item_texts[index] = text
+            self._items_df = None
+        else:
+            self.bonus_texts[index] = text
+            self._bonus_items_df = None
+
+    def low_conf_prices(self, max_conf):
+        """Return the prices with a known position and a confidence below max_conf as (conf, kind, index, box)."""
+        prices = []
+        for kind, confs, boxes in [("item", self.item_confs, self.item_boxes), ("bonus_item", self.bonus_confs, self.bonus_boxes)]:
+            prices.extend((conf, kind, i, box) for i, (conf, box) in enumerate(zip(confs, boxes))
+                          if box is not None and conf is not None and conf < max_conf)
+        for key in self.PRICE_KEYS:
+            conf = getattr(self, f"{key}_conf")
+            if key in self.price_boxes and conf is not None and conf < max_conf:
+                prices.append((conf, key, None, self.price_boxes[key]))
+        return sorted(prices, key=lambda price: price[0])
+
+    @classmethod
+    def from_dict(cls, receipt_dict):
+        """Build receipt from a dict like to_dict returns. Prices may be strings or numbers, confidences are optional."""
+        def price(value):
+            return decimal.Decimal(str(value).replace(",", ".")).quantize(decimal.Decimal('.01'), decimal.ROUND_HALF_UP)
+        receipt = cls(receipt_dict.get("supermarket", "AH"), list(receipt_dict.get("participants", [])))
+        items = receipt_dict.get("items", [])
+        receipt.add_items([price(item["price"]) for item in items], [item.get("price_conf") for item in items],
+                          [item.get("bonus") for item in items], [item.get("item_text", "") for item in items])
+        bonus_items = receipt_dict.get("bonus_items", [])
+        receipt.add_bonus_items([price(item["price"]) for item in bonus_items], [item.get("price_conf") for item in bonus_items],
+                                [item.get("bonus_text", "") for item in bonus_items],
+                                links=[item.get("item") for item in bonus_items])
+        for key in cls.PRICE_KEYS:
+            receipt.set_price(key, None, price(receipt_dict.get(key, 0)), receipt_dict.get(f"{key}_conf"))
+        return receipt
+
+    @staticmethod
+    def check_totals(item_sum, bonus_sum, nr_bonus_items, subtotal, bonus, total):
+        """Return which totals match the sums of the item prices."""
+        if nr_bonus_items > 0:
+            bonus_correct = bonus_sum == bonus
+        else:  # No bonus items, always correct
+            bonus_correct = True
+        return {"subtotal": item_sum == subtotal, "bonus": bonus_correct, "total": (subtotal - bonus) == total}
+
+    def verify_prices(self):
+        """Check if all the totals match."""
+        totals = self.check_totals(sum(self.item_prices), sum(self.bonus_prices), len(self.bonus_prices), self.subtotal,
+                                   self.bonus, self.total)
+        self.verify = totals
+        if sum(totals.values()) == len(totals):
+            print("All items and totals add up.")
+        else:
+            print(f"Totals do not add up: {totals}")  # TODO log this
+            for key, correct in totals.items():
+                if not correct:
+                    print(f"{key} does not add up!")
@@ -1,14 +1,24 @@
+import contextlib
 import datetime
 import decimal
-import itertools
-import random
+import hashlib
+import os
 import re
+import tempfile
+import time
 
 from dominate.tags import *
-from flask import redirect, render_template, request
+from flask import Response, abort, jsonify, redirect, render_template, request
 from werkzeug.utils import secure_filename
 
-from app import ah_bon_OCR, app
+from app import app, metrics
+from app.admission import RateLimiter
+from app.jobs import ClientQueueFull, JobQueue, QueueFull
+from app.layouts import LAYOUTS
+from app.ocr_cache import OCRCache
+from app.products import ProductDictionary
+from app.sessions import ReceiptStore
+from app.splitter import Splitter, to_cents
 
 
 def timestamp():
@@ -56,113 +66,75 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def build_participants_html(receipt, cur_div, price_id):
-    """Build HTML for participants."""
-    with cur_div:
-        for name in receipt.participants:
-            with div(style="display:inline", _class="mx-2"):
-                button("-", type="button", _class="btn btn-danger btn-sm", onclick=f"decCount('{price_id}_{name}')")
-                input_(_class="form-control form-control-sm", type="number", name=f"{price_id}_{name}", id=f"{price_id}_{name}", value="1", size="1")
-                button("+", type="button", _class="btn btn-success btn-sm", onclick=f"incCount('{price_id}_{name}')")
-    return cur_div
-
-
-def build_items_html(receipt):
-    """Build HTML for shopping items."""
-    items_html = div()
-    with items_html:
-        h4("Boodschappen:")
-        input_(_class="form-control form-control-sm", type="text", value="Product", disabled="",
-               size="16", style="font-weight:bold")
-        input_(_class="form-control form-control-sm", type="text", value="Prijs", size="7", readonly="", style="font-weight:bold")
-        for i, user in enumerate(receipt.participants):
-            if i % 2 == 1:
-                cur_size = "8"
-            else:
-                cur_size = "9"
-            input_(_class="form-control form-control-sm mx-2", type="text", value=user, disabled="",
-                   size=cur_size)
-
-    for index, row in receipt.items.iterrows():
-        cur_div = div(_class="form-group")  # Item elements of item list
-        with cur_div:
-            input_(_class="form-control form-control-sm", type="text", value=f"{row['item_text']}", disabled="",
-                   size="16")
-            if receipt.verify["subtotal"] is True:
-                input_(_class="form-control form-control-sm is-valid", type="number", name=f"item_{index}",
-                       value=f"{row['price']}", size="4", readonly="")
-            else:
-                input_(_class="form-control form-control-sm is-invalid", type="number", name=f"item_{index}",
-                       value=f"{row['price']}", size="4")
-        cur_div = build_participants_html(receipt, cur_div, f"item_{index}")
-        items_html.add(cur_div)
-    cur_div = div(_class="form-group")  # Subtotal element of item list
-    with cur_div:
-        input_(_class="form-control form-control-sm", type="text", value="Subtotaal", disabled="", size="16",
-               style="font-weight:bold")
-        if receipt.verify["subtotal"] is True:
-            input_(_class="form-control form-control-sm is-valid", type="number", name="subtotal",
-                   value=f"{receipt.subtotal}", size="5", readonly="")
-        else:
-            input_(_class="form-control form-control-sm is-invalid", type="number", name="subtotal",
-                   value=f"{receipt.subtotal}", size="5")
-    items_html.add(cur_div)
-    items_html.add(br())
-    return items_html
-
-
-def build_bonus_html(receipt):
-    """Build HTML for bonus discount."""
-    bonus_html = div()
-    bonus_html.add(h4("Bonus:"))
-    if len(receipt.bonus_items) != 0:
-        for index, row in receipt.bonus_items.iterrows():
-            cur_div = div(_class="form-group")  # Bonus item elements of bonus item list
-            with cur_div:
-                input_(_class="form-control form-control-sm", type="text", value=f"{row['bonus_text']}", disabled="",
-                       size="16")
-                if receipt.verify["bonus"] is True:
-                    input_(_class="form-control form-control-sm is-valid", type="number", name=f"bonus_item_{index}",
-                           value=f"{row['price']}", size="4", readonly="")
-                else:
-                    input_(_class="form-control form-control-sm is-invalid", type="number", name=f"bonus_item_{index}",
-                           value=f"{row['price']}", size="4")
-            cur_div = build_participants_html(receipt, cur_div, f"bonus_item_{index}")
-            bonus_html.add(cur_div)
-    cur_div = div(_class="form-group")  # Bonus total element of bonus item list
-    with cur_div:
-        input_(_class="form-control form-control-sm", type="text", value="Uw voordeel", disabled="", size="16",
-               style="font-weight:bold")
-        if receipt.verify["bonus"] is True:
-            input_(_class="form-control form-control-sm is-valid", type="number", name="bonus",
-                   value=f"{receipt.bonus}", size="4", readonly="")
-        else:
-            input_(_class="form-control form-control-sm is-invalid", type="number", name="bonus",
-                   value=f"{receipt.bonus}", size="4")
-    bonus_html.add(cur_div)
-    bonus_html.add(br())
-    return bonus_html
-
-
-def build_total_html(receipt):
-    """Build HTML for total price."""
-    total_html = div()
-    with total_html:
-        with div(_class="form-group"):  # Total element
-            input_(_class="form-control form-control-sm", type="text", value="Totaal", disabled="", size="16",
-                   style="font-weight:bold")
-            if receipt.verify["total"] is True:
-                input_(_class="form-control form-control-sm is-valid", type="number", name="total",
-                       value=f"{receipt.total}", size="5", readonly="")
-            else:
-                input_(_class="form-control form-control-sm is-invalid", type="number", name="total",
-                       value=f"{receipt.total}", size="5")
-            input_(type="hidden", name="participants", value=",".join(receipt.participants))
-            input_(type="hidden", name="nr_items", value=len(receipt.items))
-            input_(type="hidden", name="nr_bonus_items", value=len(receipt.bonus_items))
-            button("Bereken splitsing", type="submit", _class="btn btn-info btn-sm mx-3")
-        br()
-    return total_html
+def remove_upload(pdf_path):
+    """Remove an uploaded pdf, ignore it if it is already removed."""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(pdf_path)
+
+
+def save_upload(input_pdf):
+    """Stream an uploaded pdf to the upload dir and check it, returns the file path. Raises ReceiptError for pdfs that
+    can't be a receipt. Uploads of jobs that never finished are removed."""
+    from app import ah_bon_OCR  # Imported on first use, the OCR libraries are slow to import
+    upload_dir = app.config['UPLOAD_DIR']
+    os.makedirs(upload_dir, exist_ok=True)
+    min_mtime = time.time() - app.config['OCR_JOB_MAX_AGE']
+    for entry in os.scandir(upload_dir):
+        with contextlib.suppress(FileNotFoundError):  # Removed by another worker
+            if entry.stat().st_mtime < min_mtime:
+                remove_upload(entry.path)
+    fd, pdf_path = tempfile.mkstemp(suffix=".pdf", dir=upload_dir)
+    try:
+        with os.fdopen(fd, "wb") as pdf_f:
+            input_pdf.save(pdf_f)  # Copied in chunks, the upload is never completely in memory
+        with ah_bon_OCR.open_pdf(pdf_path) as doc:
+            ah_bon_OCR.check_pdf(doc)  # Refuse before the job is queued, nothing is decoded yet
+    except BaseException:
+        remove_upload(pdf_path)
+        raise
+    return pdf_path
+
+
+def upload_rate_limited(ip, nr_uploads=1):
+    """Take upload tokens of the client, return seconds it has to wait if it uploads too fast, 0 if it may upload."""
+    retry_after = UPLOAD_LIMITER.take(ip, nr_uploads)
+    if retry_after:
+        metrics.inc("admission_total", result="rate_limited")
+    return retry_after
+
+
+def too_many_requests(error_msg, retry_after):
+    """Return the fast 429 page for refused uploads."""
+    return render_template('submit.html', error=error_msg), 429, {"Retry-After": str(retry_after)}
+
+
+def ocr_job(payload):
+    """Background job that reads the receipt pdf, returns the session token of the receipt."""
+    from app import ah_bon_OCR
+    pdf_path, supermarket, users = payload
+    try:
+        with metrics.stage("ocr_job"), metrics.memory("ocr_job"):
+            receipt = ah_bon_OCR.process_receipt(pdf_path, supermarket, users, cache=OCR_CACHE,
+                                                 timeout=app.config['OCR_JOB_TIMEOUT'], strips=app.config['OCR_STRIPS'],
+                                                 products=PRODUCTS)
+    finally:
+        remove_upload(pdf_path)
+    return RECEIPTS.put(receipt)
+
+
+def adjust_form_data(receipt, token):
+    """Return the data the adjust form template is rendered from."""
+    form_data = {
+        "token": token,
+        "participants": receipt.participants,
+        "items": list(zip(receipt.item_texts, receipt.item_prices)),
+        "bonus_items": list(zip(receipt.bonus_texts, receipt.bonus_prices)),
+        "subtotal": receipt.subtotal,
+        "bonus": receipt.bonus,
+        "total": receipt.total,
+        "verify": receipt.verify,
+    }
+    return form_data
 
 
 def format_price(price):
@@ -173,90 +145,70 @@ def format_price(price):
     return price.quantize(cents, decimal.ROUND_HALF_UP)
 
 
-def process_form(receipt_form):
-    """Process submitted form. Uses a point system to make sure single cents that can't be split will be divided fairly."""
-    ONE_CENT = decimal.Decimal("0.01")
-    item_sum = 0
-    bonus_sum = 0
+def form_price(receipt_form, key, price):
+    """Return the price corrected by the user, or the parsed price if it was not corrected."""
+    if key in receipt_form:
+        return format_price(receipt_form[key])
+    return price
+
+
+def share_form(receipt, receipt_shares):
+    """Build the form that process_form expects from a share assignment.
+
+    receipt_shares has the shares of every user per item index as {"items": {"0": {user: nr}}, "bonus_items": {...}},
+    items that are not listed are shared by "default" (1 share for every participant if not given). Bonus items that are
+    not listed are shared like the item they discount.
+    """
+    default = receipt_shares.get("default", dict.fromkeys(receipt.participants, 1))
+    receipt_form = {}
+    for key_prefix, nr_items in [("item", len(receipt.item_prices)), ("bonus_item", len(receipt.bonus_prices))]:
+        item_shares = receipt_shares.get(f"{key_prefix}s", {})
+        for i in range(nr_items):
+            if key_prefix == "bonus_item" and receipt.bonus_links[i] is not None:
+                cur_default = receipt_shares.get("items", {}).get(str(receipt.bonus_links[i]), default)
+            else:
+                cur_default = default
+            cur_shares = item_shares.get(str(i), cur_default)
+            for user in receipt.participants:
+                receipt_form[f"{key_prefix}_{i}_{user}"] = cur_shares.get(user, 0)
+    return receipt_form
+
+
+def split_seed(receipt):
+    """Return seed for the tie-breaks of the splitter, the same receipt is always split the same way."""
+    receipt_key = repr((receipt.participants, receipt.item_prices, receipt.bonus_prices, receipt.total))
+    return hashlib.sha256(receipt_key.encode()).hexdigest()
+
+
+def process_form(receipt, receipt_form):
+    """Process submitted form. Prices are split in whole cents, see splitter.Splitter for how leftover cents are divided."""
     receipt_dic = {}
-    receipt_dic["participants"] = receipt_form["participants"].split(",")
-    receipt_dic["nr_items"] = int(receipt_form["nr_items"])
-    receipt_dic["nr_bonus_items"] = int(receipt_form["nr_bonus_items"])
-    receipt_dic["subtotal"] = format_price(receipt_form["subtotal"])
-    receipt_dic["bonus"] = format_price(receipt_form["bonus"])
-    receipt_dic["total"] = format_price(receipt_form["total"])
-    receipt_dic["user_totals"] = {}
-    for user in receipt_dic["participants"]:  # Innit totals for every user
-        receipt_dic["user_totals"][user] = 0
-    receipt_dic["leftover_points"] = {}  # dict that keeps track of who is assinged 1 cent extra because they cannot be split
-    for i in range(2, len(receipt_dic["participants"]) + 1): # Loop over all combinations of 2 or more users
-        for subset in itertools.combinations(receipt_dic["participants"], i):  # Generate combination of i users
-            comb_key = tuple(subset)
-            receipt_dic["leftover_points"][comb_key] = {}  # create a point dict for every combination of users
-            for user in subset:  # create a dict for every user that occurs in a certain combination of users
-                receipt_dic["leftover_points"][comb_key][user] = 0  # Start with 0 points
+    receipt_dic["participants"] = receipt.participants
+    receipt_dic["subtotal"] = form_price(receipt_form, "subtotal", receipt.subtotal)
+    receipt_dic["bonus"] = form_price(receipt_form, "bonus", receipt.bonus)
+    receipt_dic["total"] = form_price(receipt_form, "total", receipt.total)
+    splitter = Splitter(receipt_dic["participants"], seed=split_seed(receipt))
+    sums = {"item": 0, "bonus_item": 0}  # Sum of item and bonus item prices in cents
     # Start processing shoping items
-    for itemtype in ["nr_items", "nr_bonus_items"]:
-        for i in range(receipt_dic[itemtype]):  # Loop over items
-            if itemtype == "nr_items":
-                item_key = f"item_{i}"
-            elif itemtype == "nr_bonus_items":
-                item_key = f"bonus_item_{i}"
-            item_price = format_price(receipt_form[item_key])
-            if itemtype == "nr_items":
-                item_sum += item_price
-            elif itemtype == "nr_bonus_items":
-                bonus_sum += item_price
+    for key_prefix, item_prices in [("item", receipt.item_prices), ("bonus_item", receipt.bonus_prices)]:
+        for i, item_price in enumerate(item_prices):  # Loop over items
+            item_key = f"{key_prefix}_{i}"
+            item_cents = to_cents(form_price(receipt_form, item_key, item_price))
+            sums[key_prefix] += item_cents
             cur_shares = {}
             for user in receipt_dic["participants"]:  # get the num of shares each users has for this item
-                user_shares = int(receipt_form[f"{item_key}_{user}"])
-                if user_shares > 0:
-                    cur_shares[user] = user_shares
-            if len(cur_shares) == 0:
-                raise Exception  # TODO return error (an item without any users)
-            elif len(cur_shares) == 1:  # Only 1 user pays for the item, don't have to split the price
-                if itemtype == "nr_items":
-                    receipt_dic["user_totals"][next(iter(cur_shares))] += item_price
-                elif itemtype == "nr_bonus_items":
-                    receipt_dic["user_totals"][next(iter(cur_shares))] -= item_price
-                continue  # Done with this item
-
-            total_shares = sum(cur_shares.values())
-            leftover_amount = item_price % (total_shares * ONE_CENT)  # Amount that cannot be divided in whole cents
-            share_price = (item_price - leftover_amount) / total_shares  # Calculate price per share
-            for user in cur_shares:  # Add the amount for the shares they have
-                if itemtype == "nr_items":
-                    receipt_dic["user_totals"][user] += (cur_shares[user] * share_price)
-                elif itemtype == "nr_bonus_items":
-                    receipt_dic["user_totals"][user] -= (cur_shares[user] * share_price)
-            # Divide leftover amount using a point system
-            comb_key = tuple(sorted(cur_shares.keys()))  # Combination of partaking users that serves as a key in receipt_dic["leftover_points"]
-            for _ in range(int(leftover_amount / ONE_CENT)):  # For every cent that still has to be divided
-                if itemtype == "nr_items":
-                    outer_val = min(receipt_dic["leftover_points"][comb_key].values())  # Min point value
-                elif itemtype == "nr_bonus_items":
-                    outer_val = max(receipt_dic["leftover_points"][comb_key].values())  # Max point value
-                
-                outer_users = [k for k, v in receipt_dic["leftover_points"][comb_key].items() if v == outer_val]  # select user(s) that gets the next cent assigned
-                sel_user = random.choice(outer_users)  # Select randomly if multiple users have the same amount of points
-                if itemtype == "nr_items":
-                    receipt_dic["leftover_points"][comb_key][sel_user] += 1 / cur_shares[sel_user]  # Give the user points proportional to the shares he has
-                    receipt_dic["user_totals"][sel_user] += ONE_CENT  # User is assigned 1 leftover cent
-                elif itemtype == "nr_bonus_items":
-                    receipt_dic["leftover_points"][comb_key][sel_user] -= 1 / cur_shares[sel_user]  # Give the user points proportional to the shares he has
-                    receipt_dic["user_totals"][sel_user] -= ONE_CENT  # User is assigned 1 leftover cent
+                cur_shares[user] = int(receipt_form[f"{item_key}_{user}"])
+            splitter.add(item_cents, cur_shares, discount=(key_prefix == "bonus_item"))  # TODO return error for an item without any users
+    receipt_dic["user_totals"] = splitter.price_totals()
     # Verify totals
     error = False
-    if receipt_dic["subtotal"] != item_sum:
+    if to_cents(receipt_dic["subtotal"]) != sums["item"]:
         error = True  # TODO log
-    if receipt_dic["bonus"] != bonus_sum:
+    if to_cents(receipt_dic["bonus"]) != sums["bonus_item"]:
         error = True  # TODO log
     if (receipt_dic["subtotal"] - receipt_dic["bonus"]) != receipt_dic["total"]:
         error = True  # TODO log
-    users_sum = 0
-    for user in receipt_dic["user_totals"]:
-        users_sum += receipt_dic["user_totals"][user]
-    if receipt_dic["total"] == users_sum:
+    if to_cents(receipt_dic["total"]) == sum(splitter.totals.values()):
         print("user totals add up") # TODO log
     else:
         error = True  # TODO log
@@ -285,7 +237,21 @@ def build_result_html(receipt_dic):
 
 # Setup vars
 ALLOWED_EXTENSIONS = {'pdf',}
-SUPERMARKETS = {"AH",}
+SUPERMARKETS = set(LAYOUTS)  # Supermarkets with a receipt layout
+LOCAL_IPS = {"127.0.0.1", "::1"}
+UPLOAD_ERRORS = {  # Messages for refused uploads by exception name, see ah_bon_OCR.check_pdf
+    "TooManyPages": "Upload een bonnetje van één pagina",
+    "ImageTooLarge": "De afbeelding in de pdf is te groot",
+}
+OCR_CACHE = OCRCache(app.config['OCR_CACHE_DIR'], app.config['OCR_CACHE_MAX_SIZE'], app.config['OCR_CACHE_MAX_AGE'])
+OCR_JOBS = JobQueue(app.config['OCR_JOBS_DB'], ocr_job, app.config['OCR_WORKERS'], app.config['OCR_QUEUE_DEPTH'],
+                    app.config['OCR_JOB_TIMEOUT'], app.config['OCR_JOB_MAX_AGE'],
+                    max_client_depth=app.config['OCR_JOBS_PER_CLIENT'])
+UPLOAD_LIMITER = RateLimiter(app.config['ADMISSION_DB'], app.config['UPLOADS_PER_MINUTE'] / 60, app.config['UPLOAD_BURST'])
+CLIENT_BUSY_RETRY = 5  # Seconds a client with too many running jobs is asked to wait
+RECEIPTS = ReceiptStore(app.config['RECEIPT_DB'], app.config['RECEIPT_TTL'])
+PRODUCTS = ProductDictionary(app.config['PRODUCT_DB'], app.config['PRODUCT_MAX'])
+metrics.enable(app.config['METRICS_ENABLED'])
 
 # Routing
 @app.route('/', methods=['GET'])
@@ -300,6 +266,10 @@ def submit():
         return render_template('submit.html')
 
     assert request.method == "POST"
+    retry_after = upload_rate_limited(ip)  # Checked before the upload is read
+    if retry_after:
+        error_msg = f"Je hebt te veel bonnetjes geüpload, probeer het over {retry_after} seconden opnieuw"
+        return too_many_requests(error_msg, retry_after)
     supermarket = request.form["supermarket"]
     if supermarket not in SUPERMARKETS:  # Verify supermarket selection
         return render_template('submit.html')  # TODO ERROR
@@ -318,22 +288,88 @@ def submit():
     if not allowed_file(input_pdf.filename):
         return render_template('submit.html')  # TODO ERROR
         #filename = secure_filename(input_pdf.filename)
-    receipt = ah_bon_OCR.process_receipt(input_pdf.stream.read(), supermarket, users)
-    # Construct HTML form
-    html_form = form(_class="form-inline", action="/Bon_Splitser/result", method="post")
-    html_form.add(build_items_html(receipt))
-    html_form.add(build_bonus_html(receipt))
-    html_form.add(build_total_html(receipt))
-    return render_template("adjust.html", html_form=html_form)
+    from app import ah_bon_OCR  # Only uploads need the OCR libraries
+    try:
+        pdf_path = save_upload(input_pdf)
+    except ah_bon_OCR.ReceiptError as e:
+        print(f"Upload refused: {e}")  # TODO log this
+        error_msg = UPLOAD_ERRORS.get(type(e).__name__, "Het bestand is geen leesbare pdf")
+        return render_template('submit.html', error=error_msg), 400
+    try:
+        job_id = OCR_JOBS.submit((pdf_path, supermarket, users), client=ip)
+    except ClientQueueFull:
+        remove_upload(pdf_path)
+        metrics.inc("admission_total", result="client_busy")
+        error_msg = "Je vorige bonnetjes worden nog gelezen, probeer het zo opnieuw"
+        return too_many_requests(error_msg, CLIENT_BUSY_RETRY)
+    except QueueFull:
+        remove_upload(pdf_path)
+        metrics.inc("admission_total", result="queue_full")
+        error_msg = "Het is op dit moment erg druk, probeer het over een minuut opnieuw"
+        return render_template('submit.html', error=error_msg), 503
+    metrics.inc("admission_total", result="admitted")
+    return redirect(f"/Bon_Splitser/job/{job_id}")
+
+
+@app.route('/Bon_Splitser/job/<job_id>', methods=['GET'])
+def job_page(job_id):
+    status, token, error = OCR_JOBS.get(job_id)
+    if status is None:
+        error_msg = "Bonnetje niet gevonden, upload het opnieuw"
+        return render_template('submit.html', error=error_msg), 404
+    if status == "failed":
+        print(f"OCR job {job_id} failed: {error}")  # TODO log this
+        error_msg = "Het bonnetje kon niet gelezen worden"
+        return render_template('submit.html', error=error_msg)
+    if status != "done":  # Job is still queued or running, let the browser poll until it is done
+        return render_template('wait.html', status_url=f"/Bon_Splitser/job/{job_id}/status")
+    return redirect(f"/Bon_Splitser/adjust/{token}")
+
+
+@app.route('/Bon_Splitser/adjust/<token>', methods=['GET'])
+def adjust(token):
+    receipt = RECEIPTS.get(token)
+    if receipt is None:
+        error_msg = "Bonnetje is verlopen, upload het opnieuw"
+        return render_template('submit.html', error=error_msg), 404
+    with metrics.stage("adjust_render"):
+        return render_template("adjust.html", **adjust_form_data(receipt, token))
+
+
+@app.route('/Bon_Splitser/job/<job_id>/status', methods=['GET'])
+def job_status(job_id):
+    return jsonify(status=OCR_JOBS.status(job_id))
 
 
 @app.route('/Bon_Splitser/result', methods=['POST'])
 def display_result():
-    receipt_dic, error = process_form(request.form)
+    token = request.form.get("token", "")
+    receipt = RECEIPTS.get(token)
+    if receipt is None:
+        error_msg = "Bonnetje is verlopen, upload het opnieuw"
+        return render_template('submit.html', error=error_msg), 404
+    with metrics.stage("split"):
+        receipt_dic, error = process_form(receipt, request.form)
     if error:
-        return render_template("result.html", error="De som van de bedragen klopt niet.")
-    result_html = build_result_html(receipt_dic)
-    return render_template("result.html", result_html=result_html)
+        return render_template("result.html", error="De som van de bedragen klopt niet.", token=token)
+    with metrics.stage("result_render"):
+        result_html = build_result_html(receipt_dic)
+        return render_template("result.html", result_html=result_html, token=token)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    if not metrics.ENABLED or get_ip() not in LOCAL_IPS:  # Metrics are only available on the server itself
+        abort(404)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.errorhandler(413)
+def too_large_handler(e):
+    max_mb = app.config['MAX_CONTENT_LENGTH'] / 1000 / 1000
+    if request.path.startswith("/api/"):
+        return jsonify(error=f"Upload is larger than {max_mb:g} MB"), 413
+    return render_template('submit.html', error=f"Het bestand is te groot, maximaal {max_mb:g} MB"), 413
 
 
 @app.errorhandler(404)
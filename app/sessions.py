@@ -0,0 +1,37 @@
+import pickle
+import secrets
+import time
+
+from app.db import SQLiteStore
+
+
+class ReceiptStore(SQLiteStore):
+    """Stores parsed receipts under a session token in SQLite, shared by all worker processes."""
+    def __init__(self, db_path, ttl):
+        super().__init__(db_path)
+        self.ttl = ttl  # Seconds a receipt is kept after it was last used
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS receipts (token TEXT PRIMARY KEY, expires REAL NOT NULL, data BLOB NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS receipts_expires ON receipts (expires)")
+
+    def put(self, receipt):
+        """Store a receipt and return its session token."""
+        token = secrets.token_urlsafe(16)
+        now = time.time()
+        db = self.connect()
+        with db:
+            db.execute("DELETE FROM receipts WHERE expires < ?", (now,))
+            db.execute("INSERT INTO receipts (token, expires, data) VALUES (?, ?, ?)",
+                       (token, now + self.ttl, pickle.dumps(receipt, protocol=pickle.HIGHEST_PROTOCOL)))
+        return token
+
+    def get(self, token):
+        """Return the receipt of a session token, None if it is unknown or expired."""
+        now = time.time()
+        db = self.connect()
+        row = db.execute("SELECT data FROM receipts WHERE token = ? AND expires >= ?", (token, now)).fetchone()
+        if row is None:
+            return None
+        with db:
+            db.execute("UPDATE receipts SET expires = ? WHERE token = ?", (now + self.ttl, token))  # Keep recently used receipts
+        return pickle.loads(row[0])
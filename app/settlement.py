@@ -0,0 +1,102 @@
+import heapq
+
+EXACT_MAX_PARTICIPANTS = 12  # Larger groups are settled greedily, the exact search takes 2^n steps
+
+
+class Settlement:
+    """Combine the splits of many receipts and compute who has to pay whom, in integer cents.
+
+    The balance of a participant is what they paid minus what they have to pay, a positive balance means money is owed
+    to them. The fewest transfers are found by splitting the participants into as many groups as possible whose
+    balances add up to 0, every group then takes one transfer less than its size. This is searched exactly over all
+    subsets for small groups and approximated by matching the largest debtor with the largest creditor otherwise.
+    """
+    def __init__(self):
+        self.balances = {}  # Balance in cents per participant
+
+    def add(self, paid_by, user_totals):
+        """Add a receipt that was paid by paid_by and is split as user_totals ({user: cents})."""
+        for user, cents in user_totals.items():
+            self.balances[user] = self.balances.get(user, 0) - cents
+        self.balances[paid_by] = self.balances.get(paid_by, 0) + sum(user_totals.values())
+
+    def transfers(self, exact_max=EXACT_MAX_PARTICIPANTS):
+        """Return list of transfers (from user, to user, cents) that settle all balances."""
+        open_balances = {user: cents for user, cents in self.balances.items() if cents != 0}
+        if sum(open_balances.values()) != 0:
+            raise ValueError("Balances don't add up to 0")
+        if len(open_balances) <= exact_max:
+            groups = zero_sum_groups(open_balances)
+        else:
+            groups = [open_balances]
+        transfers = []
+        for group in groups:
+            transfers.extend(greedy_transfers(group))
+        return transfers
+
+
+def greedy_transfers(balances):
+    """Settle balances that add up to 0 by repeatedly paying from the largest debtor to the largest creditor.
+
+    Every transfer settles at least one participant, so a group of n takes at most n - 1 transfers.
+    """
+    debtors = [(cents, user) for user, cents in balances.items() if cents < 0]  # Most negative first
+    creditors = [(-cents, user) for user, cents in balances.items() if cents > 0]
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+    transfers = []
+    while debtors and creditors:
+        debt, debtor = heapq.heappop(debtors)
+        credit, creditor = heapq.heappop(creditors)
+        cents = min(-debt, -credit)
+        transfers.append((debtor, creditor, cents))
+        if debt + cents < 0:
+            heapq.heappush(debtors, (debt + cents, debtor))
+        if credit + cents < 0:
+            heapq.heappush(creditors, (credit + cents, creditor))
+    return transfers
+
+
+def zero_sum_groups(balances):
+    """Split balances that add up to 0 into the largest number of groups that each add up to 0.
+
+    Dynamic programming over all subsets: groups[mask] is the max number of zero sum groups the users in mask can be
+    split into when they are taken in some order, the order is then traced back and cut where the running sum is 0.
+    """
+    users = list(balances)
+    amounts = [balances[user] for user in users]
+    nr_masks = 1 << len(users)
+    sums = [0] * nr_masks
+    groups = [0] * nr_masks
+    for mask in range(1, nr_masks):
+        low_bit = mask & -mask
+        sums[mask] = sums[mask ^ low_bit] + amounts[low_bit.bit_length() - 1]
+        best = 0
+        bit_mask = mask
+        while bit_mask:
+            bit = bit_mask & -bit_mask
+            best = max(best, groups[mask ^ bit])
+            bit_mask ^= bit
+        groups[mask] = best + (sums[mask] == 0)
+    # Trace back the order in which users were added, cutting a group every time the running sum is 0
+    order = []
+    mask = nr_masks - 1
+    while mask:
+        bit_mask = mask
+        while bit_mask:
+            bit = bit_mask & -bit_mask
+            if groups[mask ^ bit] + (sums[mask] == 0) == groups[mask]:
+                break
+            bit_mask ^= bit
+        order.append(bit.bit_length() - 1)
+        mask ^= bit
+    result = []
+    group = {}
+    running_sum = 0
+    for i in reversed(order):
+        group[users[i]] = amounts[i]
+        running_sum += amounts[i]
+        if running_sum == 0:
+            result.append(group)
+            group = {}
+    return result
@@ -0,0 +1,74 @@
+import decimal
+import heapq
+import math
+import random
+
+
+def to_cents(price):
+    """Convert a Decimal price to integer cents."""
+    return int((decimal.Decimal(price) * 100).to_integral_value(decimal.ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    """Convert integer cents to a Decimal price."""
+    return decimal.Decimal(cents).scaleb(-2)
+
+
+class Splitter:
+    """Split prices in integer cents between participants.
+
+    Every participant pays the same amount per share. Cents that can't be divided evenly are handed out with a point
+    system per combination of participants: the next cent goes to the user with the fewest points, who then gets
+    1/shares points. Discount cents go to the user with the most points instead. Points are only kept for combinations
+    of participants that actually occur, ties are broken randomly with a seedable random generator.
+    """
+    def __init__(self, participants, seed=None):
+        self.participants = list(participants)
+        self.totals = dict.fromkeys(self.participants, 0)  # Amount in cents every participant has to pay
+        self.points = {}  # Leftover points per combination of participants, as (denominator, {user: points numerator})
+        self.rng = random.Random(seed)
+
+    def add(self, cents, shares, discount=False):
+        """Split an item between the users in shares ({user: nr of shares}). Discounts are subtracted."""
+        shares = {user: nr for user, nr in shares.items() if nr > 0}
+        if len(shares) == 0:
+            raise ValueError("Item has no participants")
+        sign = -1 if discount else 1
+        if len(shares) == 1:  # Only 1 user pays for the item, don't have to split the price
+            self.totals[next(iter(shares))] += sign * cents
+            return
+        share_cents, leftover = divmod(cents, sum(shares.values()))
+        for user, nr in shares.items():
+            self.totals[user] += sign * nr * share_cents
+        if leftover:
+            for user in self.allocate(shares, leftover, discount):
+                self.totals[user] += sign
+
+    def allocate(self, shares, leftover, discount=False):
+        """Return the users that get the leftover cents of an item, a user can get more than one cent."""
+        comb_key = tuple(sorted(shares))
+        scale, points = self.points.get(comb_key, (1, None))
+        if points is None:
+            points = dict.fromkeys(comb_key, 0)
+        # Points are kept as integers over a common denominator that every number of shares divides
+        new_scale = math.lcm(scale, *shares.values())
+        if new_scale != scale:
+            for user in points:
+                points[user] *= new_scale // scale
+        self.points[comb_key] = (new_scale, points)
+        sign = -1 if discount else 1
+        # All cents of the item are handed out in one go from a heap ordered on points (negated for discounts)
+        heap = [(sign * points[user], self.rng.random(), user) for user in shares]
+        heapq.heapify(heap)
+        users = []
+        for _ in range(leftover):
+            _, tie_break, user = heapq.heappop(heap)
+            users.append(user)
+            points[user] += sign * (new_scale // shares[user])  # 1/shares points
+            heapq.heappush(heap, (sign * points[user], tie_break, user))
+        return users
+
+    def price_totals(self):
+        """Return the totals of every participant as Decimal prices."""
+        return {user: from_cents(cents) for user, cents in self.totals.items()}
+
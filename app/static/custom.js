@@ -26,3 +26,17 @@ function addInput(){
     counter++;
 }
 
+
+// poll OCR job until the receipt is read
+function pollJob(statusUrl) {
+    fetch(statusUrl)
+        .then(response => response.json())
+        .then(data => {
+            if (data.status == "queued" || data.status == "running") {
+                setTimeout(function() { pollJob(statusUrl); }, 1000);
+            } else {
+                location.reload();
+            }
+        })
+        .catch(() => setTimeout(function() { pollJob(statusUrl); }, 3000));
+}
@@ -0,0 +1,112 @@
+import argparse
+import concurrent.futures
+import contextlib
+import decimal
+import functools
+import glob
+import json
+import os
+import sys
+
+from app import ah_bon_OCR, app, routes
+from app.ocr_cache import OCRCache
+from app.products import ProductDictionary
+from app.settlement import Settlement
+from app.splitter import from_cents, to_cents
+
+
+def find_pdfs(paths):
+    """Return sorted list of pdf files in the given directories and glob patterns."""
+    pdfs = set()
+    for path in paths:
+        if os.path.isdir(path):
+            pdfs.update(glob.glob(os.path.join(path, "*.pdf")))
+        else:
+            pdfs.update(glob.glob(path))
+    return sorted(pdfs)
+
+
+@functools.lru_cache(maxsize=None)
+def product_dictionary():
+    """Return the product dictionary of the web app, one per worker process so its index is only loaded once."""
+    return ProductDictionary(app.config['PRODUCT_DB'], app.config['PRODUCT_MAX'])
+
+
+def read_receipt(pdf_path, supermarket, participants, receipt_shares, use_cache):
+    """Read and split one receipt in a worker process. Errors are returned instead of raised."""
+    try:
+        with contextlib.redirect_stdout(sys.stderr):  # stdout is reserved for the JSON lines
+            cache = None
+            products = None
+            if use_cache:
+                cache = OCRCache(app.config['OCR_CACHE_DIR'], app.config['OCR_CACHE_MAX_SIZE'], app.config['OCR_CACHE_MAX_AGE'])
+                products = product_dictionary()
+            receipt = ah_bon_OCR.process_receipt(pdf_path, supermarket, participants, cache=cache, products=products)
+            result = {"file": pdf_path, **receipt.to_dict()}
+            if participants:
+                receipt_dic, error = routes.process_form(receipt, routes.share_form(receipt, receipt_shares))
+                result["user_totals"] = {user: str(total) for user, total in receipt_dic["user_totals"].items()}
+                result["split_error"] = error
+    except Exception as e:
+        return {"file": pdf_path, "error": f"{type(e).__name__}: {e}"}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read a batch of receipt pdfs in parallel and write the results as JSON lines.")
+    parser.add_argument("paths", nargs="+", help="directories or glob patterns of receipt pdfs")
+    parser.add_argument("--shares", help="JSON file with participants and how the receipts are shared")
+    parser.add_argument("--supermarket", default="AH", choices=sorted(routes.SUPERMARKETS))
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of worker processes (default: all cores)")
+    parser.add_argument("--no-cache", action="store_true", help="don't use the OCR cache and product names of the web app")
+    args = parser.parse_args()
+
+    shares = {}
+    if args.shares:
+        with open(args.shares) as shares_f:
+            shares = json.load(shares_f)
+    participants = shares.get("participants", [])
+    pdfs = find_pdfs(args.paths)
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")  # Parallelism comes from the processes, one Tesseract thread each
+
+    user_totals = dict.fromkeys(participants, decimal.Decimal("0.00"))
+    settlement = Settlement()
+    paid_by = {}  # Who paid each receipt, from the shares file
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for pdf_path in pdfs:
+            receipt_shares = shares.get("receipts", {}).get(os.path.basename(pdf_path), {})
+            if "paid_by" in receipt_shares or "paid_by" in shares:
+                paid_by[pdf_path] = receipt_shares.get("paid_by", shares.get("paid_by"))
+            if "default" in shares and "default" not in receipt_shares:
+                receipt_shares = {"default": shares["default"], **receipt_shares}
+            future = executor.submit(read_receipt, pdf_path, args.supermarket, participants, receipt_shares, not args.no_cache)
+            futures[future] = pdf_path
+        for future in concurrent.futures.as_completed(futures):  # Write results as soon as they are done
+            try:
+                result = future.result()
+            except Exception as e:  # Worker process died
+                result = {"file": futures[future], "error": f"{type(e).__name__}: {e}"}
+            if "error" in result:
+                failed += 1
+            for user, total in result.get("user_totals", {}).items():
+                user_totals[user] += decimal.Decimal(total)
+            if "user_totals" in result and result["file"] in paid_by:
+                result["paid_by"] = paid_by[result["file"]]
+                settlement.add(result["paid_by"], {user: to_cents(total) for user, total in result["user_totals"].items()})
+            print(json.dumps(result), flush=True)
+    summary = {"receipts": len(pdfs), "failed": failed}
+    if participants:
+        summary["user_totals"] = {user: str(total) for user, total in user_totals.items()}
+    if paid_by:  # Who has to pay whom to settle all receipts that were read
+        summary["balances"] = {user: str(from_cents(cents)) for user, cents in settlement.balances.items()}
+        summary["transfers"] = [{"from": from_user, "to": to_user, "amount": str(from_cents(cents))}
+                                for from_user, to_user, cents in settlement.transfers()]
+    print(json.dumps({"summary": summary}), flush=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import argparse
+import contextlib
+import datetime
+import decimal
+import glob
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+from flask import render_template
+from werkzeug.datastructures import MultiDict
+
+from app import ah_bon_OCR, app, routes
+from app.ah_bon_OCR import Receipt
+from app.products import ProductDictionary
+from app.settlement import Settlement
+from app.splitter import Splitter
+from tests.legacy_parser import parse_lines_iterrows
+
+TEST_PDFS = sorted(glob.glob("test_data/ah_*.pdf"))
+PREPROCESS_VARIANTS = {  # name: preprocess settings of img_from_pdf
+    "raw": None,
+    "default": ah_bon_OCR.PREPROCESS,
+    "150dpi_binarized": dict(ah_bon_OCR.PREPROCESS, max_dpi=150, binarize=True),
+}
+ITEM_WORDS = ["AH", "KAAS", "MELK", "BROOD", "HALFVOLLE", "BANANEN", "KIP", "PINDAKAAS", "1,99", "2X"]
+
+
+def synthetic_items(nr_items, seed=0):
+    """Return list of random receipt items (price, price_conf, bonus, item_text)."""
+    rng = random.Random(seed)
+    items = []
+    for _ in range(nr_items):
+        price = decimal.Decimal(rng.randint(1, 4000)) / 100
+        items.append((price, float(rng.randint(30, 99)), rng.choice([None, None, "B", "35%"]), f" 1 AH PRODUCT {rng.randint(1, 999)}"))
+    return items
+
+
+def synthetic_receipt(nr_items, nr_participants, seed=0):
+    """Return a Receipt with random items and bonus items."""
+    receipt = Receipt("AH", [f"user_{i}" for i in range(nr_participants)])
+    for item in synthetic_items(nr_items, seed):
+        receipt.add_item(*item)
+    for price, price_conf, bonus, item_text in synthetic_items(nr_items // 10, seed + 1):
+        receipt.add_bonus_item(price, price_conf, item_text)
+    receipt.subtotal = sum(receipt.item_prices)
+    receipt.bonus = sum(receipt.bonus_prices)
+    receipt.total = receipt.subtotal - receipt.bonus
+    with contextlib.redirect_stdout(io.StringIO()):
+        receipt.verify_prices()
+    return receipt
+
+
+def synthetic_words(nr_items, seed=0):
+    """Return a random word table like receipt_ocr returns for an AH receipt."""
+    rng = random.Random(seed)
+    lines = [["ALBERT", "HEIJN"], ["AANTAL", "OMSCHRIJVING", "PRIJS", "BEDRAG"], ["BONUSKAART", "xx1234"]]
+    subtotal = 0
+    for _ in range(nr_items):
+        cents = rng.randint(1, 4000)
+        subtotal += cents
+        words = [str(rng.randint(1, 3))] + rng.sample(ITEM_WORDS, rng.randint(1, 3)) + [f"{cents // 100},{cents % 100:02d}"]
+        words += rng.choice([[], [], ["B"], ["35%"]])
+        lines.append(words)
+    lines.append(["SUBTOTAAL", f"{subtotal // 100},{subtotal % 100:02d}"])
+    for _ in range(nr_items // 10):
+        lines.append(["BONUS"] + rng.sample(ITEM_WORDS, 2) + [f"-0,{rng.randint(10, 99)}"])
+    lines += [["UW", "VOORDEEL", "0,00"], ["TOTAAL", "0,00"], ["BETAALD", "MET", "PINNEN"]]
+    rows = []
+    for line_nr, words in enumerate(lines):
+        for word_nr, word in enumerate(words):
+            rows.append({"word_num": word_nr + 1, "conf": float(rng.randint(30, 99)), "text": word, "left": 10 + 80 * word_nr,
+                         "width": 70, "top": 30 * line_nr, "height": 20, "global_line": line_nr})
+    return pd.DataFrame(rows)
+
+
+def synthetic_products(nr_products, nr_reads, seed=0):
+    """Return an in-memory product dictionary with random product names, and OCR reads of some of them with one wrong
+    character."""
+    rng = random.Random(seed)
+    words = ["".join(rng.choice("ABCDEFGHIJKLMNOPRSTUVWZ") for _ in range(rng.randint(3, 9))) for _ in range(nr_products // 10)]
+    names = list({f"AH {' '.join(rng.sample(words, rng.randint(1, 3)))} {rng.choice(['', '1L', '500G', '6X'])}".strip()
+                  for _ in range(nr_products)})
+    products = ProductDictionary(":memory:", nr_products)
+    products.learn("AH", names, [])
+    reads = []
+    for name in rng.sample(names, nr_reads):
+        i = rng.randrange(3, len(name))
+        reads.append(name[:i] + rng.choice("0OIL1 ") + name[i + 1:])
+    return products, reads
+
+
+def share_form(receipt):
+    """Return the form a browser submits for a receipt, every participant has 1 share of everything."""
+    form = MultiDict({"token": "benchmark"})
+    for key_prefix, nr_items in [("item", len(receipt.item_prices)), ("bonus_item", len(receipt.bonus_prices))]:
+        for i in range(nr_items):
+            for user in receipt.participants:
+                form[f"{key_prefix}_{i}_{user}"] = "1"
+    return form
+
+
+def old_receipt_items(items):
+    """Store items like the old Receipt did, one dataframe per item concatenated at the end."""
+    dfs = [pd.DataFrame([{"price": price, "price_conf": price_conf, "bonus": bonus, "item_text": item_text}])
+           for price, price_conf, bonus, item_text in items]
+    df = pd.concat(dfs)
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+
+def new_receipt_items(items):
+    """Store items in a Receipt and build the dataframe once."""
+    receipt = Receipt("AH", ["Alice", "Bob"])
+    for item in items:
+        receipt.add_item(*item)
+    return receipt.items
+
+
+def parse_words(df, parser):
+    """Parse a word table into a new receipt."""
+    return parser(df, Receipt("AH", ["Alice", "Bob"]))
+
+
+def random_split(rng, nr_participants, nr_items):
+    """Split random items between random groups of participants, return the splitter and expected total in cents."""
+    participants = [f"user_{i}" for i in range(nr_participants)]
+    splitter = Splitter(participants, seed=rng.random())
+    expected = 0
+    for _ in range(nr_items):
+        cents = rng.randint(1, 5000)
+        users = rng.sample(participants, rng.randint(1, min(nr_participants, 8)))
+        shares = {user: rng.randint(1, 3) for user in users}
+        discount = rng.random() < 0.2
+        splitter.add(cents, shares, discount=discount)
+        expected += -cents if discount else cents
+    return splitter, expected
+
+
+def random_settlement(rng, nr_participants, nr_receipts, exact_max):
+    """Settle random receipts, each split between a random group and paid by one of them, return the transfers."""
+    participants = [f"user_{i}" for i in range(nr_participants)]
+    settlement = Settlement()
+    for _ in range(nr_receipts):
+        users = rng.sample(participants, rng.randint(1, min(nr_participants, 8)))
+        settlement.add(rng.choice(users), {user: rng.randint(0, 5000) for user in users})
+    return settlement, settlement.transfers(exact_max=exact_max)
+
+
+def render_adjust_form(receipt):
+    """Render the adjust page of a receipt."""
+    with app.test_request_context():
+        return render_template("adjust.html", **routes.adjust_form_data(receipt, "benchmark"))
+
+
+def render_result(receipt, form):
+    """Split a receipt and render the result page."""
+    receipt_dic, error = routes.process_form(receipt, form)
+    with app.test_request_context():
+        return render_template("result.html", result_html=routes.build_result_html(receipt_dic), token="benchmark")
+
+
+def ocr_receipt(pdf, preprocess, strips=1):
+    """Return the receipt read from the pdf with OCR after preprocessing."""
+    receipt = Receipt("AH", [])
+    with contextlib.redirect_stdout(io.StringIO()):
+        ah_bon_OCR.parse_lines(ah_bon_OCR.receipt_ocr(ah_bon_OCR.img_from_pdf(pdf, preprocess), strips=strips), receipt)
+        receipt.verify_prices()
+    return receipt.to_dict()
+
+
+def check_ocr_variants():
+    """Compare receipts read with every preprocess variant and with strips against the raw image, exits if any differs."""
+    variants = [(variant, preprocess, 1) for variant, preprocess in PREPROCESS_VARIANTS.items() if preprocess is not None]
+    variants.append((f"strips{os.cpu_count()}", ah_bon_OCR.PREPROCESS, os.cpu_count()))
+    failed = []
+    for pdf_path in TEST_PDFS:
+        name = os.path.basename(pdf_path)
+        expected = ocr_receipt(pdf_path, None)
+        for variant, preprocess, strips in variants:
+            receipt = ocr_receipt(pdf_path, preprocess, strips)
+            prices_same = all(receipt[key] == expected[key] for key in ["subtotal", "bonus", "total"]) and \
+                [item["price"] for item in receipt["items"]] == [item["price"] for item in expected["items"]]
+            texts_same = [item["item_text"] for item in receipt["items"]] == [item["item_text"] for item in expected["items"]]
+            print(f"OCR variant {variant:<20} {name:<12} prices {'same' if prices_same else 'DIFFERENT'}, "
+                  f"item texts {'same' if texts_same else 'different'}, verify {receipt['verify']}")
+            if not prices_same:
+                failed.append(f"{variant}[{name}]")
+    if failed:
+        sys.exit(f"OCR variants changed the prices of {', '.join(failed)}")
+
+
+def pdf_to_image(pdf):
+    """Open and check a pdf and extract its preprocessed image, like a receipt upload."""
+    with ah_bon_OCR.open_pdf(pdf) as doc:
+        ah_bon_OCR.check_pdf(doc)
+        return ah_bon_OCR.img_from_pdf(doc, ah_bon_OCR.PREPROCESS)
+
+
+def run_python(code):
+    """Run code in a new Python process, to measure import and startup times."""
+    subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
+
+
+def tesseract_available():
+    """Check if Tesseract can be used for OCR."""
+    try:
+        ah_bon_OCR.ocr_version()
+    except (OSError, RuntimeError):  # pytesseract raises TesseractNotFoundError, an OSError
+        return False
+    return True
+
+
+def collect_benchmarks(ocr):
+    """Return list of benchmarks as (name, function, args)."""
+    benchmarks = [("startup[import_app]", run_python, ("import app",))]
+    if ocr and TEST_PDFS:
+        first_receipt = f"from app import ah_bon_OCR; ah_bon_OCR.process_receipt({TEST_PDFS[0]!r}, 'AH', [])"
+        benchmarks.append(("startup[first_receipt]", run_python, (first_receipt,)))
+        benchmarks.append(("startup[warm_up]", run_python, ("import os; os.environ['OCR_WARMUP'] = '1'; import wsgi",)))
+    for pdf_path in TEST_PDFS:
+        name = os.path.basename(pdf_path)
+        with open(pdf_path, "rb") as pdf_f:
+            pdf = pdf_f.read()
+        benchmarks.append((f"pdf_to_image[{name},bytes]", pdf_to_image, (pdf,)))
+        benchmarks.append((f"pdf_to_image[{name},file]", pdf_to_image, (pdf_path,)))
+        for variant, preprocess in PREPROCESS_VARIANTS.items():
+            benchmarks.append((f"img_from_pdf[{name},{variant}]", ah_bon_OCR.img_from_pdf, (pdf, preprocess)))
+        if ocr:
+            for variant, preprocess in PREPROCESS_VARIANTS.items():
+                image = ah_bon_OCR.img_from_pdf(pdf, preprocess)
+                benchmarks.append((f"receipt_ocr[{name},{variant}]", ah_bon_OCR.receipt_ocr, (image,)))
+            image = ah_bon_OCR.img_from_pdf(pdf, ah_bon_OCR.PREPROCESS)
+            for strips in sorted({2, os.cpu_count()}):
+                benchmarks.append((f"receipt_ocr[{name},strips{strips}]", ah_bon_OCR.receipt_ocr, (image, 0, strips)))
+            df = ah_bon_OCR.receipt_ocr(image)
+            benchmarks.append((f"parse_lines[{name}]", parse_words, (df, ah_bon_OCR.parse_lines)))
+            benchmarks.append((f"process_receipt[{name}]", ah_bon_OCR.process_receipt, (pdf, "AH", ["Alice", "Bob"])))
+    for nr_items in [20, 200]:
+        df = synthetic_words(nr_items)
+        benchmarks.append((f"parse_lines[synthetic_{nr_items}]", parse_words, (df, ah_bon_OCR.parse_lines)))
+        benchmarks.append((f"parse_lines_iterrows[synthetic_{nr_items}]", parse_words, (df, parse_lines_iterrows)))
+    items = synthetic_items(1000)
+    benchmarks.append(("receipt_items_old[1000]", old_receipt_items, (items,)))
+    benchmarks.append(("receipt_items[1000]", new_receipt_items, (items,)))
+    for nr_items, nr_participants in [(20, 2), (200, 10), (200, 50)]:
+        receipt = synthetic_receipt(nr_items, nr_participants)
+        form = share_form(receipt)
+        label = f"{nr_items}x{nr_participants}"
+        benchmarks.append((f"process_form[{label}]", routes.process_form, (receipt, form)))
+        benchmarks.append((f"adjust_render[{label}]", render_adjust_form, (receipt,)))
+        benchmarks.append((f"result_render[{label}]", render_result, (receipt, form)))
+    for nr_products in [1000, 50000]:
+        products, reads = synthetic_products(nr_products, 100)
+        benchmarks.append((f"product_snap[{nr_products},100_reads]", products.snap, ("AH", reads)))
+    benchmarks.append(("splitter[100x5000]", random_split, (random.Random(0), 100, 5000)))
+    for nr_participants, nr_receipts, exact_max in [(12, 300, 12), (12, 300, 0), (50, 500, 0)]:
+        method = "exact" if exact_max else "greedy"
+        benchmarks.append((f"settlement[{nr_participants}x{nr_receipts},{method}]", random_settlement,
+                           (random.Random(0), nr_participants, nr_receipts, exact_max)))
+    return benchmarks
+
+
+def measure(func, args, warmup=1, repeat=5):
+    """Return wall times, throughput and peak traced memory of func(*args)."""
+    with contextlib.redirect_stdout(io.StringIO()):  # Hide progress prints of the app
+        for _ in range(warmup):
+            func(*args)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    median = statistics.median(times)
+    return {"min_s": min(times), "median_s": median, "per_sec": 1 / median if median else None, "peak_kib": peak / 1024}
+
+
+def compare(results, baseline, tolerance):
+    """Print change against baseline results, return names of benchmarks that got slower than the tolerance."""
+    regressions = []
+    print(f"\n{'benchmark':<40} {'baseline ms':>12} {'now ms':>10} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]["median_s"]
+        change = result["median_s"] / old - 1 if old else 0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print(f"{name:<40} {old * 1000:>12.2f} {result['median_s'] * 1000:>10.2f} {change:>+8.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark OCR, parsing, splitting and rendering of bon splitser.")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs per benchmark")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--no-ocr", action="store_true", help="skip benchmarks that need Tesseract")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare results against a JSON file written with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline (0.2 is 20%%)")
+    parser.add_argument("--check", action="store_true",
+                        help="also compare OCR results of the preprocess and strip variants")
+    args = parser.parse_args()
+
+    ocr = not args.no_ocr and tesseract_available()
+    if not ocr:
+        print("Tesseract not used, skipping OCR benchmarks")
+    elif args.check:
+        check_ocr_variants()
+    results = {}
+    print(f"{'benchmark':<40} {'median ms':>10} {'min ms':>10} {'per sec':>9} {'peak KiB':>10}")
+    for name, func, func_args in collect_benchmarks(ocr):
+        if args.filter not in name:
+            continue
+        result = measure(func, func_args, warmup=args.warmup, repeat=args.repeat)
+        results[name] = result
+        print(f"{name:<40} {result['median_s'] * 1000:>10.2f} {result['min_s'] * 1000:>10.2f} "
+              f"{result['per_sec']:>9.1f} {result['peak_kib']:>10.1f}")
+
+    if args.output:
+        meta = {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "ocr": ah_bon_OCR.ocr_version() if ocr else None,
+            "repeat": args.repeat,
+            "warmup": args.warmup,
+        }
+        with open(args.output, "w") as output_f:
+            json.dump({"meta": meta, "results": results}, output_f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_f:
+            baseline = json.load(baseline_f)["results"]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
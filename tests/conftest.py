@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+# Importing any module of the app package also sets up the Flask app, which creates its databases under "cache/".
+# Run the tests from a temporary directory so they don't touch the cache of the repo.
+os.chdir(tempfile.mkdtemp(prefix="bon_splitser_tests_"))
@@ -0,0 +1,102 @@
+# Old row by row parser of AH receipts, replaced by ah_bon_OCR.parse_lines. Kept to check that parse_lines gives the same
+# receipts (tests/test_parser.py) and to compare their speed in the benchmark.
+import re
+
+from app.ah_bon_OCR import ah_price
+
+
+def parse_start(line, df_line):
+    """Check if the line of the receipt is the start of the item table. Returns what to do with the next line."""
+    for index, row in df_line.iterrows():  # Loop over words
+        if row["text"].upper() == "AANTAL" or row["text"].upper() == "OMSCHRIJVING" or row["text"].upper() == "PRIJS" or row["text"].upper() == "BEDRAG":
+            return "parse_items"
+    return "start"
+
+
+def parse_items(bonuskaart_skip, line, df_line, receipt):
+    """Parse shopping items from the receipt."""
+    # Check for bonuskaart line
+    if bonuskaart_skip == False:
+        for index, row in df_line.iterrows():  # Loop over words
+            if row["text"].upper() == "BONUSKAART":
+                return True, "parse_items", receipt  # Skip bonuskaart check from now on
+    # Check for subtotal line
+    for index, row in df_line.iterrows():  # Loop over words
+        if row["text"].upper() == "SUBTOTAAL":
+            receipt.subtotal = ah_price(df_line.iloc[-1]["text"])
+            receipt.subtotal_conf = float(df_line.iloc[-1]["conf"])
+            return bonuskaart_skip, "parse_bonus", receipt
+
+    # Get price and bonus info
+    bonus = None
+    price_loc = -1
+    last_row = df_line.iloc[price_loc]
+    for bonus_id in ["B", "35%"]: # Check for bonus and 35% discount
+        if bonus_id in last_row["text"].upper():  # Check if bonus present
+            bonus = bonus_id
+            if bonus_id == last_row["text"].upper():  # If word only contains the bonus_id and not the price
+                price_loc = -2
+                price_row = df_line.iloc[price_loc]  # Price row is the word before bonus_id
+            else:  # Price and bonus_id are in the same word. Need to extract price
+                last_row["text"] = last_row["text"].replace(bonus_id, "").replace(" ", "")  # Remove bonus_id and spaces
+                price_row = last_row
+            break
+    else:
+        price_row = last_row
+    price = ah_price(price_row["text"])
+    price_conf = float(price_row["conf"])
+
+    # Get item text
+    price_re = r"\d{1,2},\d{2}"
+    item_text = ""
+    for index, row in df_line.iloc[0:price_loc].iterrows():  # Loop over words before price
+        if re.match(price_re, row["text"]):  # Skip price of single item
+            continue
+        else:
+            item_text = f"{item_text} {row['text']}"
+    receipt.add_item(price, price_conf, bonus, item_text)
+    return bonuskaart_skip, "parse_items", receipt
+
+
+def parse_bonus(line, df_line, receipt):
+    """Parse bonus items from the receipt."""
+    # Check for bonus total
+    for index, row in df_line.iterrows():  # Loop over words
+        if row["text"].upper() == "VOORDEEL":
+            receipt.bonus = ah_price(df_line.iloc[-1]["text"])
+            receipt.bonus_conf = float(df_line.iloc[-1]["conf"])
+            return "parse_total", receipt
+    # Parse bonus items
+    bonus_price = ah_price(df_line.iloc[-1]["text"].replace("-", ""))
+    price_conf = float(df_line.iloc[-1]["conf"])
+    bonus_text = df_line.iloc[0:-1]["text"].str.cat(sep=" ").upper()  # Merge bonus text
+    bonus_text = bonus_text.replace("BONUS", "").replace("35% K", "")
+    receipt.add_bonus_item(bonus_price, price_conf, bonus_text)
+    return "parse_bonus", receipt
+
+
+def parse_total(line, df_line, receipt):
+    """Parse total from receipt."""
+    for index, row in df_line.iterrows():  # Loop over words
+        if row["text"].upper() == "TOTAAL":
+            receipt.total = ah_price(df_line.iloc[-1]["text"])
+            receipt.total_conf = float(df_line.iloc[-1]["conf"])
+            return "end", receipt
+    return "parse_total", receipt
+
+
+def parse_lines_iterrows(df, receipt):
+    """Parse OCR words into the receipt line by line with the parse stage functions."""
+    parse_stage = "start"
+    bonuskaart_skip = False
+    grouped = df.groupby(["global_line"])
+    for name, df_group in grouped:  # Loop over lines
+        if parse_stage == "start":
+            parse_stage = parse_start(name, df_group)
+        elif parse_stage == "parse_items":
+            bonuskaart_skip, parse_stage, receipt = parse_items(bonuskaart_skip, name, df_group, receipt)
+        elif parse_stage == "parse_bonus":
+            parse_stage, receipt = parse_bonus(name, df_group, receipt)
+        elif parse_stage == "parse_total":
+            parse_stage, receipt = parse_total(name, df_group, receipt)
+    return receipt
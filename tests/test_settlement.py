@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from app.settlement import Settlement
+
+
+def random_settlement(rng, nr_participants, nr_receipts):
+    """Return a settlement of random receipts, each split between a random group and paid by one of them."""
+    participants = [f"user_{i}" for i in range(nr_participants)]
+    settlement = Settlement()
+    for _ in range(nr_receipts):
+        users = rng.sample(participants, rng.randint(1, min(nr_participants, 8)))
+        settlement.add(rng.choice(users), {user: rng.randint(0, 5000) for user in users})
+    return settlement
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_transfers_settle_balances(seed):
+    rng = random.Random(seed)
+    nr_participants = rng.randint(2, 10)
+    settlement = random_settlement(rng, nr_participants, rng.randint(1, 20))
+    exact = settlement.transfers(exact_max=nr_participants)
+    greedy = settlement.transfers(exact_max=0)
+    for transfers in [exact, greedy]:
+        balances = dict(settlement.balances)
+        for from_user, to_user, cents in transfers:
+            assert cents > 0
+            balances[from_user] += cents
+            balances[to_user] -= cents
+        assert all(cents == 0 for cents in balances.values())
+    # The exact search never needs more transfers than greedy, and greedy never more than one less than the open balances
+    nr_open = len([cents for cents in settlement.balances.values() if cents != 0])
+    assert len(exact) <= len(greedy) <= max(nr_open - 1, 0)
+
+
+def test_zero_sum_pairs_are_settled_separately():
+    settlement = Settlement()
+    settlement.balances = {"a": 500, "b": -500, "c": 300, "d": -300}
+    assert sorted(settlement.transfers()) == [("b", "a", 500), ("d", "c", 300)]
+
+
+def test_unbalanced():
+    settlement = Settlement()
+    settlement.balances = {"a": 1}
+    with pytest.raises(ValueError):
+        settlement.transfers()
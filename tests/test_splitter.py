@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+from app.splitter import Splitter
+
+
+def random_split(rng, nr_participants, nr_items, seed=None):
+    """Split random items between random groups of participants, return the splitter and expected total in cents."""
+    participants = [f"user_{i}" for i in range(nr_participants)]
+    splitter = Splitter(participants, seed=seed)
+    expected = 0
+    for _ in range(nr_items):
+        cents = rng.randint(1, 5000)
+        users = rng.sample(participants, rng.randint(1, min(nr_participants, 8)))
+        shares = {user: rng.randint(1, 3) for user in users}
+        discount = rng.random() < 0.2
+        splitter.add(cents, shares, discount=discount)
+        expected += -cents if discount else cents
+    return splitter, expected
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_totals_add_up(seed):
+    rng = random.Random(seed)
+    splitter, expected = random_split(rng, rng.randint(2, 20), rng.randint(1, 50), seed=seed)
+    assert sum(splitter.totals.values()) == expected
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_equal_shares_differ_at_most_one_cent(seed):
+    rng = random.Random(seed)
+    nr_users = rng.randint(2, 10)
+    splitter = Splitter(range(nr_users), seed=seed)
+    for _ in range(rng.randint(1, 50)):
+        splitter.add(rng.randint(1, 5000), dict.fromkeys(range(nr_users), 1), discount=rng.random() < 0.2)
+    assert max(splitter.totals.values()) - min(splitter.totals.values()) <= 1
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_same_seed_same_split(seed):
+    totals = [random_split(random.Random(seed), 7, 30, seed=f"receipt_{seed}")[0].totals for _ in range(5)]
+    assert all(cur_totals == totals[0] for cur_totals in totals)
+
+
+def test_many_participants():
+    splitter, expected = random_split(random.Random(0), 100, 5000, seed=0)
+    assert sum(splitter.totals.values()) == expected
+
+
+def test_item_without_participants():
+    with pytest.raises(ValueError):
+        Splitter(["Alice", "Bob"]).add(100, {"Alice": 0})
@@ -1,4 +1,11 @@
 from app import app
 
+if app.config['OCR_WARMUP']:  # Workers forked by the uWSGI master share the loaded OCR state copy-on-write
+    from app import ah_bon_OCR
+    try:
+        ah_bon_OCR.warm_up()
+    except Exception as e:  # Workers load the engine on their first receipt instead
+        print(f"OCR warm-up failed: {e}")  # TODO log this
+
 if __name__ == "__main__":
     app.run()